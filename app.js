@@ -26,32 +26,176 @@ const $ = (id) => document.getElementById(id);
 const show = (id) => $(id).classList.remove('hidden');
 const hide = (id) => $(id).classList.add('hidden');
 
+// --- PERSISTENCE: IndexedDB ---
+// Antes cada escaneo re-serializaba todo el batch en localStorage (O(total) por lectura)
+// y la maestra completa se reescribía al agregar un producto. Ahora:
+// - journal: log append-only, una escritura O(1) por escaneo (key = seq autoincremental)
+// - meta.ackedSeq: último seq confirmado por el servidor; pendientes = seq > ackedSeq
+// - master: un registro por código, se actualiza solo el producto que cambia
+// La compactación borra del journal lo ya confirmado.
+// Si IndexedDB no está disponible se vuelve a la escritura completa en localStorage.
+const ScanStore = {
+    DB_NAME: 'inv_pda',
+    DB_VERSION: 1,
+    db: null,
+
+    open: function () {
+        return new Promise((resolve, reject) => {
+            const req = indexedDB.open(this.DB_NAME, this.DB_VERSION);
+            req.onupgradeneeded = () => {
+                const db = req.result;
+                db.createObjectStore('journal', { keyPath: 'seq', autoIncrement: true });
+                db.createObjectStore('master', { keyPath: 'code' });
+                db.createObjectStore('meta');
+            };
+            req.onsuccess = () => { this.db = req.result; resolve(this.db); };
+            req.onerror = () => reject(req.error);
+        });
+    },
+
+    // Helper: run fn(stores) in one transaction, resolve with its result once committed
+    tx: function (names, mode, fn) {
+        return new Promise((resolve, reject) => {
+            const t = this.db.transaction(names, mode);
+            const stores = names.map(n => t.objectStore(n));
+            let result;
+            t.oncomplete = () => resolve(result);
+            t.onerror = () => reject(t.error);
+            t.onabort = () => reject(t.error);
+            result = fn(...stores);
+        });
+    },
+
+    request: function (req) {
+        return new Promise((resolve, reject) => {
+            req.onsuccess = () => resolve(req.result);
+            req.onerror = () => reject(req.error);
+        });
+    },
+
+    // One-time import of the old localStorage keys
+    migrateLegacy: async function () {
+        const savedMaster = localStorage.getItem('inv_master');
+        if (savedMaster) {
+            const parsed = JSON.parse(savedMaster);
+            await this.tx(['master'], 'readwrite', (master) => {
+                Object.entries(parsed).forEach(([code, p]) => master.put({ code, ...p }));
+            });
+            localStorage.removeItem('inv_master');
+        }
+        const savedBatch = localStorage.getItem('inv_batch');
+        if (savedBatch) {
+            // Legacy batch is newest-first; journal is append order
+            const batch = JSON.parse(savedBatch).reverse();
+            await this.tx(['journal'], 'readwrite', (journal) => {
+                batch.forEach(r => journal.add(r));
+            });
+            localStorage.removeItem('inv_batch');
+        }
+    },
+
+    loadMaster: async function () {
+        const rows = await this.tx(['master'], 'readonly', (master) => this.request(master.getAll()));
+        return new Map(rows.map(r => [r.code, { name: r.name, stock: r.stock }]));
+    },
+
+    putProducts: function (entries) {
+        return this.tx(['master'], 'readwrite', (master) => {
+            entries.forEach(([code, p]) => master.put({ code, ...p }));
+        });
+    },
+
+    getAckedSeq: async function () {
+        const v = await this.tx(['meta'], 'readonly', (meta) => this.request(meta.get('ackedSeq')));
+        return v || 0;
+    },
+
+    append: async function (record) {
+        record.seq = await this.tx(['journal'], 'readwrite', (journal) => this.request(journal.add(record)));
+        return record.seq;
+    },
+
+    // Entries not yet acknowledged by the server, in scan order
+    pending: async function () {
+        const acked = await this.getAckedSeq();
+        const range = IDBKeyRange.lowerBound(acked, true);
+        return this.tx(['journal'], 'readonly', (journal) => this.request(journal.getAll(range)));
+    },
+
+    ack: async function (seq) {
+        await this.tx(['meta'], 'readwrite', (meta) => meta.put(seq, 'ackedSeq'));
+        await this.compact();
+    },
+
+    compact: async function () {
+        const acked = await this.getAckedSeq();
+        if (!acked) return;
+        await this.tx(['journal'], 'readwrite', (journal) => journal.delete(IDBKeyRange.upperBound(acked)));
+    },
+
+    clearJournal: function () {
+        return this.tx(['journal'], 'readwrite', (journal) => journal.clear());
+    },
+
+    // Fallback without IndexedDB: the old full localStorage write (batch newest-first)
+    loadLegacy: function () {
+        const savedMaster = localStorage.getItem('inv_master');
+        const savedBatch = localStorage.getItem('inv_batch');
+        return {
+            master: new Map(Object.entries(savedMaster ? JSON.parse(savedMaster) : {})),
+            batch: savedBatch ? JSON.parse(savedBatch).reverse() : []
+        };
+    },
+
+    saveLegacyBatch: function (batch) {
+        try {
+            localStorage.setItem('inv_batch', JSON.stringify(batch.slice().reverse()));
+        } catch (e) {
+            console.error("Error guardando escaneos en localStorage", e);
+        }
+    },
+
+    saveLegacyMaster: function (master) {
+        try {
+            localStorage.setItem('inv_master', JSON.stringify(Object.fromEntries(master)));
+        } catch (e) {
+            console.error("Error guardando maestra en localStorage", e);
+        }
+    }
+};
+
 // --- APP CONTROLLER ---
 const app = {
-    init: function () {
-        this.loadPersistedData();
+    init: async function () {
+        await this.loadPersistedData();
         this.checkSession();
         this.setupGlobalListeners();
         console.log("🚀 App Initialized");
     },
 
-    loadPersistedData: function () {
-        // Cargar Maestra (optimizada en Map)
-        const savedMaster = localStorage.getItem('inv_master');
-        if (savedMaster) {
+    loadPersistedData: async function () {
+        try {
+            await ScanStore.open();
+            await ScanStore.migrateLegacy();
+            await ScanStore.compact();
+
+            // Cargar Maestra (optimizada en Map para O(1))
+            AppState.masterData = await ScanStore.loadMaster();
+            console.log(`📦 Maestra cargada: ${AppState.masterData.size} productos`);
+
+            // Cargar BatchOffline (solo lo no confirmado por el servidor)
+            AppState.batchData = await ScanStore.pending();
+        } catch (e) {
+            console.error("Error abriendo IndexedDB, usando localStorage", e);
+            ScanStore.db = null;
             try {
-                // Convertir Objeto a Map para O(1)
-                const parsed = JSON.parse(savedMaster);
-                AppState.masterData = new Map(Object.entries(parsed));
-                console.log(`📦 Maestra cargada: ${AppState.masterData.size} productos`);
-            } catch (e) {
-                console.error("Error cargando maestra", e);
+                const legacy = ScanStore.loadLegacy();
+                AppState.masterData = legacy.master;
+                AppState.batchData = legacy.batch;
+            } catch (err) {
+                console.error("Error leyendo localStorage", err);
             }
         }
-
-        // Cargar BatchOffline
-        const savedBatch = localStorage.getItem('inv_batch');
-        if (savedBatch) AppState.batchData = JSON.parse(savedBatch);
     },
 
     checkSession: function () {
@@ -181,19 +325,27 @@ const app = {
 
         try {
             this.toast("Enviando datos...");
+            // Journal feeds the sync directly: only entries after the last acknowledged seq
+            const pending = ScanStore.db ? await ScanStore.pending() : AppState.batchData.slice();
+            const lastSeq = pending.length ? pending[pending.length - 1].seq : 0;
             const response = await fetch('http://localhost:8001/api/sync', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(AppState.batchData)
+                body: JSON.stringify(pending)
             });
 
             if (response.ok) {
                 const data = await response.json();
                 alert("✅ Servidor dice: " + data.message);
 
-                // Limpiar cola local
-                AppState.batchData = [];
-                localStorage.removeItem('inv_batch');
+                // Confirmar hasta lastSeq; lo escaneado durante el envío sigue pendiente
+                if (ScanStore.db && lastSeq) {
+                    await ScanStore.ack(lastSeq);
+                    AppState.batchData = AppState.batchData.filter(r => !(r.seq <= lastSeq)); // keeps scans still being written
+                } else {
+                    AppState.batchData = AppState.batchData.slice(pending.length);
+                    if (!ScanStore.db) ScanStore.saveLegacyBatch(AppState.batchData);
+                }
                 this.updateRecentList();
             } else {
                 alert("❌ Error del servidor");
@@ -230,9 +382,13 @@ const app = {
             dev: AppState.deviceName
         };
 
-        // Add to batch
-        AppState.batchData.unshift(record);
-        localStorage.setItem('inv_batch', JSON.stringify(AppState.batchData));
+        // Add to batch (append, oldest first) + O(1) journal write
+        AppState.batchData.push(record);
+        if (ScanStore.db) {
+            ScanStore.append(record).catch(e => console.error("Error guardando escaneo", e));
+        } else {
+            ScanStore.saveLegacyBatch(AppState.batchData);
+        }
 
         // UI Feedback
         this.showFeedback(name, code);
@@ -255,7 +411,7 @@ const app = {
     },
 
     updateRecentList: function () {
-        const list = AppState.batchData.slice(0, 5); // Show last 5
+        const list = AppState.batchData.slice(-5).reverse(); // Show last 5, newest first
         $('mobileList').innerHTML = list.map(item => `
             <li class="glass-panel" style="padding:10px; margin-bottom:5px; list-style:none; display:flex; justify-content:space-between;">
                 <span>${item.name}</span>
@@ -293,9 +449,9 @@ const app = {
                 }
             });
 
-            // Persist Map as Obj
-            const mapObj = Object.fromEntries(AppState.masterData);
-            localStorage.setItem('inv_master', JSON.stringify(mapObj));
+            // Persist all products in one transaction
+            if (ScanStore.db) await ScanStore.putProducts([...AppState.masterData]);
+            else ScanStore.saveLegacyMaster(AppState.masterData);
 
             $('adminStatus').textContent = `✅ Importación éxitosa: ${count} productos.`;
             this.toast(`Maestra actualizada: ${count} items`);
@@ -322,7 +478,7 @@ const app = {
     renderAdminTable: function () {
         // En un sistema real esto vendría del server. Aquí simulamos con lo local.
         const tb = $('adminTableBody');
-        const data = AppState.batchData; // Show local batch for demo
+        const data = AppState.batchData.slice().reverse(); // Show local batch for demo, newest first
         tb.innerHTML = data.map(r => `
             <tr>
                 <td>${r.code}</td>
@@ -337,7 +493,8 @@ const app = {
     clearData: function () {
         if (confirm("¿Limpiar todo el monitoreo?")) {
             AppState.batchData = [];
-            localStorage.removeItem('inv_batch');
+            if (ScanStore.db) ScanStore.clearJournal();
+            else ScanStore.saveLegacyBatch(AppState.batchData);
             this.renderAdminTable();
         }
     },
@@ -359,9 +516,9 @@ const app = {
 
         AppState.masterData.set(code, { name, stock: 0 });
 
-        // Update storage
-        const mapObj = Object.fromEntries(AppState.masterData);
-        localStorage.setItem('inv_master', JSON.stringify(mapObj));
+        // Update storage: only this product
+        if (ScanStore.db) ScanStore.putProducts([[code, { name, stock: 0 }]]);
+        else ScanStore.saveLegacyMaster(AppState.masterData);
 
         this.closeModal();
         this.registerScan(code, name);
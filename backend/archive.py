@@ -0,0 +1,194 @@
+"""Archive of closed inventories, out of the hot tables.
+
+Once an inventory is closed its stock and lecturas never change, but they kept
+weighing on every query, index and backup of INV_STOCK_TEORICO / INV_LECTURAS.
+Archiving packs them (plus the materialized reconciliation and report) into a
+single INV_ARCHIVO row as zlib-compressed JSON and deletes the hot rows.
+Readers call load_archivo() first and fall back to the hot tables, so archived
+inventories stay readable from every endpoint.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import text
+from datetime import datetime, date
+from decimal import Decimal
+from database import delete_chunked, ensure_archivo_table
+import json
+import os
+import zlib
+
+# How often the scheduler looks for closed inventories that are not archived yet
+ARCHIVE_INTERVAL_MINUTES = int(os.getenv("ARCHIVE_INTERVAL_MINUTES", "60"))
+
+CAMPOS = ("Stock", "Lecturas", "Resumen")
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        # DATETIME only keeps milliseconds; this form also inserts back as-is on restore
+        return obj.isoformat(timespec="milliseconds")
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return str(obj)
+
+
+def _pack(obj) -> bytes:
+    return zlib.compress(json.dumps(obj, default=_default, separators=(",", ":")).encode("utf-8"), 6)
+
+
+def _unpack(blob: bytes):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+def is_archivado(db: Session, inv_id: int) -> bool:
+    ensure_archivo_table()
+    row = db.execute(text("SELECT 1 FROM INV_ARCHIVO WHERE IdInventario = :inv"), {"inv": inv_id}).first()
+    return row is not None
+
+
+def load_archivo(db: Session, inv_id: int, campo: str):
+    """Decoded Stock / Lecturas / Resumen of an archived inventory, or None if it is not archived"""
+    if campo not in CAMPOS:
+        raise ValueError(f"Campo de archivo invalido: {campo}")
+    ensure_archivo_table()
+    blob = db.execute(text(f"SELECT {campo} FROM INV_ARCHIVO WHERE IdInventario = :inv"),
+                      {"inv": inv_id}).scalar()
+    return _unpack(blob) if blob is not None else None
+
+
+def pendientes_archivo(db: Session) -> list:
+    """Ids of closed inventories still living in the hot tables"""
+    ensure_archivo_table()
+    rows = db.execute(text("""
+        SELECT c.Id FROM INV_CABECERA c
+        WHERE c.Estado = 'cerrado'
+            AND NOT EXISTS (SELECT 1 FROM INV_ARCHIVO a WHERE a.IdInventario = c.Id)
+        ORDER BY c.FechaCreacion
+    """)).all()
+    return [r.Id for r in rows]
+
+
+# Rows per executemany batch when restoring (same reasoning as database.DELETE_CHUNK;
+# engine_ferrini uses fast_executemany, so each batch is one round trip)
+RESTORE_CHUNK = 4000
+
+
+def huella_inventario(db: Session, inv_id: int) -> tuple:
+    """Cheap fingerprint of an inventory's hot rows (changes on any sync, delete or edit)"""
+    return tuple(db.execute(text("""
+        SELECT
+            (SELECT COUNT(*) FROM INV_STOCK_TEORICO WHERE IdInventario = :inv) as StockCount,
+            (SELECT ISNULL(MAX(Id),0) FROM INV_STOCK_TEORICO WHERE IdInventario = :inv) as StockMaxId,
+            (SELECT COUNT(*) FROM INV_LECTURAS WHERE IdInventario = :inv) as LecturasCount,
+            (SELECT ISNULL(SUM(Cantidad),0) FROM INV_LECTURAS WHERE IdInventario = :inv) as LecturasQty,
+            (SELECT ISNULL(MAX(Id),0) FROM INV_LECTURAS WHERE IdInventario = :inv) as LecturasMaxId
+    """), {"inv": inv_id}).first())
+
+
+def lock_cabecera(db: Session, inv_id: int, compartido: bool = False):
+    """Estado of the inventory, with its header row locked until the transaction ends.
+
+    iniciar and the archive insert take an update lock, so a reopen never races the
+    archive's last check and its insert. sync only needs a shared one (compartido):
+    syncs from several PDAs still run side by side, while cerrar's UPDATE waits for
+    them, and the archive only proceeds once the estado is 'cerrado'.
+    """
+    hint = "HOLDLOCK" if compartido else "UPDLOCK, HOLDLOCK"
+    return db.execute(text(f"SELECT Estado FROM INV_CABECERA WITH ({hint}) WHERE Id = :id"),
+                      {"id": inv_id}).scalar()
+
+
+def archivar_inventario(db: Session, inv_id: int, materializar, on_chunk=None) -> dict:
+    """Pack a closed inventory into INV_ARCHIVO, then delete its hot rows in chunks.
+
+    materializar() builds the Resumen blob and runs without locks, so once
+    everything is read the estado and the fingerprint of the hot rows are
+    checked again under the header lock, in the same transaction as the
+    insert; if the inventory was reopened or edited meanwhile nothing is
+    archived and the job fails (the scheduler retries it later).
+
+    The archive row is committed before anything is deleted, so readers always
+    find the data in one place or the other. Re-running it on an already
+    archived inventory only finishes the deletes.
+    """
+    estado = db.execute(text("SELECT Estado FROM INV_CABECERA WHERE Id = :id"), {"id": inv_id}).scalar()
+    if estado != "cerrado":
+        raise ValueError(f"Inventario #{inv_id} no esta cerrado (estado: {estado})")
+
+    total_stock = total_lecturas = 0
+    if not is_archivado(db, inv_id):
+        huella = huella_inventario(db, inv_id)
+        stock = [dict(r) for r in db.execute(text("""
+            SELECT Id, SKU, ALU, Descripcion, Departamento, Modelo, Proveedor, Temporada, StockTeorico
+            FROM INV_STOCK_TEORICO WHERE IdInventario = :inv
+            ORDER BY Departamento, Modelo
+        """), {"inv": inv_id}).mappings()]
+        lecturas = [dict(r) for r in db.execute(text("""
+            SELECT Id, SKU, ALU, Descripcion, Cantidad, Ubicacion, Dispositivo, ISNULL(Origen,'scanner') as Origen, FechaHora
+            FROM INV_LECTURAS WHERE IdInventario = :inv
+            ORDER BY FechaHora DESC
+        """), {"inv": inv_id}).mappings()]
+        resumen = materializar()
+        total_stock = len(stock)
+        total_lecturas = sum(int(l["Cantidad"] or 0) for l in lecturas)
+
+        estado = lock_cabecera(db, inv_id)
+        if estado != "cerrado":
+            db.rollback()
+            raise ValueError(f"Inventario #{inv_id} cambio a '{estado}' mientras se archivaba")
+        if huella_inventario(db, inv_id) != huella:
+            db.rollback()
+            raise ValueError(f"Inventario #{inv_id} se modifico mientras se archivaba; se reintentara")
+        if not is_archivado(db, inv_id):
+            db.execute(text("""
+                INSERT INTO INV_ARCHIVO (IdInventario, TotalStock, TotalLecturas, Stock, Lecturas, Resumen)
+                VALUES (:inv, :tstock, :tlect, :stock, :lecturas, :resumen)
+            """), {
+                "inv": inv_id, "tstock": total_stock, "tlect": total_lecturas,
+                "stock": _pack(stock), "lecturas": _pack(lecturas), "resumen": _pack(resumen)
+            })
+        db.commit()
+
+    borrados = delete_chunked(db, "INV_LECTURAS", inv_id, on_chunk)
+    borrados += delete_chunked(db, "INV_STOCK_TEORICO", inv_id, on_chunk)
+    return {"inventario_id": inv_id, "stock": total_stock, "lecturas": total_lecturas, "borrados": borrados}
+
+
+def restaurar_inventario(db: Session, inv_id: int, on_total=None, on_chunk=None) -> dict:
+    """Move an archived inventory back into the hot tables (e.g. when it is reopened).
+
+    Rows are inserted in committed chunks; readers keep using INV_ARCHIVO until
+    its row is deleted. That final DELETE is left uncommitted so the caller can
+    reopen the inventory in the same transaction.
+    """
+    stock = load_archivo(db, inv_id, "Stock")
+    if stock is None:
+        return {"inventario_id": inv_id, "stock": 0, "lecturas": 0}
+    lecturas = load_archivo(db, inv_id, "Lecturas") or []
+    if on_total:
+        on_total(len(stock) + len(lecturas))
+
+    # Leftovers of an earlier failed restore or of an unfinished archive delete
+    delete_chunked(db, "INV_LECTURAS", inv_id)
+    delete_chunked(db, "INV_STOCK_TEORICO", inv_id)
+
+    stock_insert = text("""
+        INSERT INTO INV_STOCK_TEORICO
+            (IdInventario, SKU, ALU, Descripcion, Departamento, Modelo, Proveedor, Temporada, StockTeorico)
+        VALUES (:inv, :SKU, :ALU, :Descripcion, :Departamento, :Modelo, :Proveedor, :Temporada, :StockTeorico)
+    """)
+    lecturas_insert = text("""
+        INSERT INTO INV_LECTURAS (IdInventario, SKU, ALU, Descripcion, Cantidad, Ubicacion, Dispositivo, Origen, FechaHora)
+        VALUES (:inv, :SKU, :ALU, :Descripcion, :Cantidad, :Ubicacion, :Dispositivo, :Origen, :FechaHora)
+    """)
+    for insert, filas in ((stock_insert, stock), (lecturas_insert, lecturas)):
+        for i in range(0, len(filas), RESTORE_CHUNK):
+            chunk = filas[i:i + RESTORE_CHUNK]
+            db.execute(insert, [{**f, "inv": inv_id} for f in chunk])
+            db.commit()
+            if on_chunk:
+                on_chunk(len(chunk))
+
+    db.execute(text("DELETE FROM INV_ARCHIVO WHERE IdInventario = :inv"), {"inv": inv_id})
+    return {"inventario_id": inv_id, "stock": len(stock), "lecturas": len(lecturas)}
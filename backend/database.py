@@ -1,7 +1,10 @@
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, text, event, exc
+from sqlalchemy.orm import sessionmaker, Session
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 import urllib.parse
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 # Load .env file if exists (for local development)
@@ -13,6 +16,35 @@ SERVER = os.getenv("DB_SERVER", "190.187.176.69")
 USERNAME = os.getenv("DB_USERNAME", "retailuser")
 PASSWORD = os.getenv("DB_PASSWORD", "retail")
 
+class RetrySession(Session):
+    """Session that retries the first statement of a transaction once on a dropped connection.
+
+    The keepalive thread replaces dead and aging connections, but one that died since
+    its last round (server restart, network blip) still fails on its next execute. If
+    that was the transaction's first statement nothing is lost: roll back (the pool has
+    already discarded the dead connection) and run it again on a fresh one. Disconnects
+    later in a transaction are raised as before, its earlier statements died with it.
+    """
+
+    def execute(self, statement, *args, **kwargs):
+        primera = not self.in_transaction() or not self.info.get("ejecutado")
+        try:
+            result = super().execute(statement, *args, **kwargs)
+        except exc.DBAPIError as e:
+            if not (primera and e.connection_invalidated):
+                raise
+            print(f"DB RECONNECT: conexion caida, reintentando ({e.orig})")
+            self.rollback()
+            result = super().execute(statement, *args, **kwargs)
+        self.info["ejecutado"] = True
+        return result
+
+
+@event.listens_for(RetrySession, "after_begin")
+def _reset_ejecutado(session, transaction, connection):
+    session.info["ejecutado"] = False
+
+
 # --- DBFERRINI (inventory persistence) ---
 params_ferrini = urllib.parse.quote_plus(
     f"DRIVER={{ODBC Driver 17 for SQL Server}};"
@@ -24,10 +56,11 @@ engine_ferrini = create_engine(
     f"mssql+pyodbc:///?odbc_connect={params_ferrini}",
     pool_size=3,        # max 3 persistent connections (enough for concurrent PDA syncs)
     max_overflow=5,     # up to 5 extra temporary connections under load
-    pool_recycle=1800,  # recycle connections every 30min (avoids stale/dropped connections)
+    pool_recycle=1800,  # recycle connections every 30min (keepalive does it ahead of time, see below)
     pool_pre_ping=False, # Disabled: reduces SSL handshake errors on legacy servers
+    fast_executemany=True, # executemany as one bulk parameter array, not one round trip per row
 )
-SessionFerrini = sessionmaker(autocommit=False, autoflush=False, bind=engine_ferrini)
+SessionFerrini = sessionmaker(class_=RetrySession, autocommit=False, autoflush=False, bind=engine_ferrini)
 
 # --- RetailDataSHOE (read-only product/store data) ---
 params_retail = urllib.parse.quote_plus(
@@ -43,7 +76,256 @@ engine_retail = create_engine(
     pool_recycle=1800,
     pool_pre_ping=False, # Disabled: reduces SSL handshake errors on legacy servers
 )
-SessionRetail = sessionmaker(autocommit=False, autoflush=False, bind=engine_retail)
+SessionRetail = sessionmaker(class_=RetrySession, autocommit=False, autoflush=False, bind=engine_retail)
+
+
+# --- Pool manager ---
+# pool_pre_ping pings on every checkout and caused SSL handshake errors on the legacy
+# server, so instead: connections are pre-opened at startup, a background thread pings
+# idle ones every POOL_KEEPALIVE_SECONDS (replacing broken ones, and ones that would hit
+# pool_recycle before the next round, off the request path), a checkout only pings when
+# the connection sat idle longer than POOL_IDLE_PING_SECONDS, and RetrySession re-runs a
+# transaction's first statement once if its connection turns out to be dead.
+POOL_KEEPALIVE_SECONDS = int(os.getenv("POOL_KEEPALIVE_SECONDS", "240"))
+POOL_IDLE_PING_SECONDS = int(os.getenv("POOL_IDLE_PING_SECONDS", "300"))
+
+ENGINES = {"DBFERRINI": engine_ferrini, "RetailDataSHOE": engine_retail}
+
+# ODBC errors for a dropped link that the mssql dialect does not classify as disconnects
+# by SQLSTATE; flagging them invalidates the connection (and lets RetrySession retry)
+DISCONNECT_MARKERS = ("Communication link failure", "TCP Provider", "SSL Provider")
+
+
+def _install_idle_ping(engine):
+    @event.listens_for(engine, "connect")
+    def _connect(dbapi_conn, record):
+        record.info["conectado"] = time.time()
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(ctx):
+        if not ctx.is_disconnect and any(m in str(ctx.original_exception) for m in DISCONNECT_MARKERS):
+            ctx.is_disconnect = True
+
+    @event.listens_for(engine, "checkin")
+    def _checkin(dbapi_conn, record):
+        record.info["last_used"] = time.monotonic()
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_conn, record, proxy):
+        last = record.info.get("last_used")
+        if last is None or time.monotonic() - last < POOL_IDLE_PING_SECONDS:
+            return
+        cursor = dbapi_conn.cursor()
+        try:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+        except Exception:
+            # The pool discards this connection and transparently retries with a fresh one
+            raise exc.DisconnectionError()
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+
+for _engine in ENGINES.values():
+    _install_idle_ping(_engine)
+
+
+def warm_pool(engine) -> int:
+    """Open connections until the pool holds pool_size of them (TLS/ODBC cost paid here, not by a request)"""
+    missing = engine.pool.size() - engine.pool.checkedin() - engine.pool.checkedout()
+    conns = []
+    try:
+        # Held together so each checkout creates a distinct connection
+        for _ in range(max(missing, 0)):
+            c = engine.connect()
+            c.exec_driver_sql("SELECT 1")
+            conns.append(c)
+    finally:
+        for c in conns:
+            c.close()
+    return len(conns)
+
+
+def keepalive_pool(engine) -> int:
+    """Ping every idle connection once, replacing dead ones and ones about to reach
+    pool_recycle, then reconnect them here. Returns how many were replaced"""
+    recycle = engine.pool._recycle
+    replaced = 0
+    # QueuePool is FIFO: checking out and returning one at a time visits each idle connection
+    for _ in range(engine.pool.checkedin()):
+        c = engine.connect()
+        try:
+            edad = time.time() - c.connection.info.get("conectado", time.time())
+            if 0 < recycle <= edad + POOL_KEEPALIVE_SECONDS:
+                # Would be recycled at a request's checkout before the next round
+                c.invalidate()
+                replaced += 1
+            else:
+                c.exec_driver_sql("SELECT 1")
+        except Exception:
+            c.invalidate()
+            replaced += 1
+        finally:
+            c.close()
+    if replaced:
+        # Invalidated entries only reconnect on their next checkout: do that now, not in a request
+        conns = []
+        try:
+            for _ in range(engine.pool.checkedin()):
+                c = engine.connect()
+                c.exec_driver_sql("SELECT 1")
+                conns.append(c)
+        finally:
+            for c in conns:
+                c.close()
+    warm_pool(engine)
+    return replaced
+
+
+def _pool_manager():
+    for nombre, engine in ENGINES.items():
+        try:
+            print(f"{nombre}: pool warm-up, {warm_pool(engine)} conexiones abiertas")
+        except Exception as e:
+            print(f"{nombre} POOL WARM-UP ERROR: {e}")
+    # Schema migration off the startup path; readers retry it lazily if this fails
+    try:
+        ensure_archivo_table()
+    except Exception as e:
+        print(f"INV_ARCHIVO MIGRATION ERROR: {e}")
+    while True:
+        time.sleep(POOL_KEEPALIVE_SECONDS)
+        for nombre, engine in ENGINES.items():
+            try:
+                replaced = keepalive_pool(engine)
+                if replaced:
+                    print(f"{nombre}: keepalive reemplazo {replaced} conexiones (caidas o por reciclar)")
+            except Exception as e:
+                print(f"{nombre} POOL KEEPALIVE ERROR: {e}")
+
+
+def start_pool_manager():
+    """Warm both pools and keep them alive from a daemon thread (never blocks startup)"""
+    threading.Thread(target=_pool_manager, name="pool-manager", daemon=True).start()
+
+
+def pool_status() -> dict:
+    return {
+        nombre: {
+            "size": engine.pool.size(),
+            "idle": engine.pool.checkedin(),
+            "enUso": engine.pool.checkedout(),
+            "overflow": engine.pool.overflow(),
+        }
+        for nombre, engine in ENGINES.items()
+    }
+
+
+# --- Parallel queries ---
+# DBFERRINI and RetailDataSHOE are independent engines, so endpoints that need both
+# dispatch their queries side by side: latency ~ slowest query instead of the sum.
+QUERY_TIMEOUT_SECONDS = int(os.getenv("QUERY_TIMEOUT_SECONDS", "120"))
+_query_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="query")
+
+
+class _QueryTask:
+    """Runs fn(session) with an ODBC query timeout and remembers the live cursor so it can be cancelled"""
+
+    def __init__(self, session, fn, timeout: int):
+        self.session = session
+        self.fn = fn
+        self.timeout = timeout
+        self.cursor = None
+        self.inicio = None      # monotonic time the task started running (None while queued)
+        self._conns = {}
+
+    def _track_cursor(self, conn, cursor, statement, parameters, context, executemany):
+        self.cursor = cursor
+
+    def _set_timeout(self, dbapi_conn, seconds: int):
+        # pyodbc applies Connection.timeout to every cursor it creates: the driver cancels
+        # the statement server-side when it runs longer (0 = no timeout, the pool default)
+        try:
+            dbapi_conn.timeout = seconds
+        except Exception:
+            pass  # no such attribute, or the connection was invalidated meanwhile
+
+    def _attach(self, conn):
+        if id(conn) in self._conns:
+            return
+        dbapi_conn = conn.connection.dbapi_connection
+        self._conns[id(conn)] = (conn, dbapi_conn)
+        event.listen(conn, "before_cursor_execute", self._track_cursor)
+        self._set_timeout(dbapi_conn, self.timeout)
+
+    def _on_begin(self, session, transaction, connection):
+        # A new connection mid-task (RetrySession retrying on a fresh one) gets the timeout too
+        self._attach(connection)
+
+    def run(self):
+        self.inicio = time.monotonic()
+        event.listen(self.session, "after_begin", self._on_begin)
+        try:
+            self._attach(self.session.connection())
+            return self.fn(self.session)
+        finally:
+            event.remove(self.session, "after_begin", self._on_begin)
+            for conn, dbapi_conn in self._conns.values():
+                self._set_timeout(dbapi_conn, 0)
+                event.remove(conn, "before_cursor_execute", self._track_cursor)
+            self._conns.clear()
+            self.cursor = None
+
+    def cancel(self):
+        cursor = self.cursor
+        if cursor is not None and hasattr(cursor, "cancel"):
+            try:
+                cursor.cancel()  # pyodbc: SQLCancel, safe to call from another thread
+            except Exception:
+                pass
+
+
+def run_parallel(tareas: dict, timeout: int = QUERY_TIMEOUT_SECONDS) -> dict:
+    """Run {nombre: (session, fn)} concurrently, fn(session) each on its own thread.
+
+    Each session must appear in only one task (sessions are not thread-safe);
+    give tasks on the same engine separate sessions. Every statement gets an
+    ODBC query timeout. If any task fails, or runs past the timeout (counted
+    from when it started, not while queued), the others are cancelled (queued
+    ones never start, running statements get SQLCancel) and the first error
+    is raised once they have all stopped using their sessions.
+    """
+    tasks = {nombre: _QueryTask(session, fn, timeout) for nombre, (session, fn) in tareas.items()}
+    futures = {_query_executor.submit(t.run): nombre for nombre, t in tasks.items()}
+    pending = set(futures)
+    fallo = None
+    vencidas = []
+    while pending:
+        done, pending = wait(pending, timeout=1, return_when=FIRST_EXCEPTION)
+        fallo = next((f for f in done if f.exception() is not None), None)
+        if fallo is not None:
+            break
+        # Backstop in case a driver ignores the query timeout
+        ahora = time.monotonic()
+        vencidas = [futures[f] for f in pending
+                    if tasks[futures[f]].inicio is not None and ahora - tasks[futures[f]].inicio > timeout + 5]
+        if vencidas:
+            break
+    if pending:
+        for f in pending:
+            if not f.cancel():
+                tasks[futures[f]].cancel()
+        # Block until the cancelled ones are done with their sessions: the caller closes
+        # them (get_db) as soon as this returns or raises
+        wait(pending)
+    if vencidas:
+        raise TimeoutError(f"Consultas sin respuesta tras {timeout}s: {', '.join(vencidas)}")
+    if fallo is not None:
+        raise fallo.exception()
+    return {nombre: f.result() for f, nombre in futures.items()}
 
 
 def get_db():
@@ -62,6 +344,59 @@ def get_retail_db():
         db.close()
 
 
+# Rows per DELETE chunk: stays under SQL Server's ~5000-lock escalation threshold,
+# so bulk deletes never take a table lock on INV_LECTURAS while PDAs are syncing
+DELETE_CHUNK = 4000
+
+
+def delete_chunked(db, table: str, inv_id: int, on_chunk=None) -> int:
+    """DELETE TOP (n) ... WHERE IdInventario in a loop, committing each chunk"""
+    total = 0
+    while True:
+        n = db.execute(text(f"DELETE TOP ({DELETE_CHUNK}) FROM {table} WHERE IdInventario = :id"),
+                       {"id": inv_id}).rowcount
+        db.commit()
+        n = max(n, 0)
+        total += n
+        if on_chunk:
+            on_chunk(n)
+        if n < DELETE_CHUNK:
+            return total
+
+
+# Closed inventories moved out of the hot tables (zlib-compressed JSON, see archive.py).
+# Unlike the original tables this one was added after go-live, so it is also created
+# at runtime by ensure_archivo_table() instead of relying on `python database.py`.
+ARCHIVO_DDL = text("""
+    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='INV_ARCHIVO' AND xtype='U')
+    CREATE TABLE INV_ARCHIVO (
+        IdInventario INT PRIMARY KEY FOREIGN KEY REFERENCES INV_CABECERA(Id),
+        FechaArchivo DATETIME DEFAULT GETDATE(),
+        TotalStock INT,
+        TotalLecturas INT,
+        Stock VARBINARY(MAX),
+        Lecturas VARBINARY(MAX),
+        Resumen VARBINARY(MAX)
+    )
+""")
+_archivo_ready = False
+_archivo_lock = threading.Lock()
+
+
+def ensure_archivo_table():
+    """Create INV_ARCHIVO if missing (idempotent; one DB round-trip per process)"""
+    global _archivo_ready
+    if _archivo_ready:
+        return
+    with _archivo_lock:
+        if _archivo_ready:
+            return
+        with engine_ferrini.connect() as conn:
+            conn.execute(ARCHIVO_DDL)
+            conn.commit()
+        _archivo_ready = True
+
+
 def init_tables():
     with engine_ferrini.connect() as conn:
         conn.execute(text("""
@@ -109,6 +444,7 @@ def init_tables():
             IF NOT EXISTS (SELECT 1 FROM sys.columns WHERE object_id = OBJECT_ID('INV_LECTURAS') AND name = 'Origen')
             ALTER TABLE INV_LECTURAS ADD Origen VARCHAR(10) DEFAULT 'scanner'
         """))
+        conn.execute(ARCHIVO_DDL)
         conn.commit()
         print("Inventory tables initialized OK")
 
@@ -0,0 +1,144 @@
+"""Background job runner for long inventory operations.
+
+Creating an inventory (copying a store's stock), deleting one and refreshing
+the maestra used to run inline in the HTTP request, holding a worker thread
+and a DB connection until a proxy timed out. They now run on a small bounded
+pool; the endpoint returns a job id at once and the client polls
+GET /api/jobs/{id} for progress.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+import os
+import time
+import uuid
+
+# Few workers on purpose: each job holds DB connections from the small pools in database.py
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOBS_MAX = 200  # finished jobs kept for polling (oldest dropped first)
+
+# Archive/restore jobs get their own single worker: materializing an archive is heavy
+# (full report + price scan), and a backlog of them must never leave crear/eliminar/
+# maestra, which the admin waits on, sitting in 'pendiente'
+_executors = {
+    "general": ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="inv-job"),
+    "archivo": ThreadPoolExecutor(max_workers=1, thread_name_prefix="inv-archivo"),
+}
+_jobs_lock = Lock()
+jobs: "OrderedDict[str, Job]" = OrderedDict()
+_resource_locks = {}
+
+
+class Job:
+    def __init__(self, tipo: str, descripcion: str, clave: str = None):
+        self.id = uuid.uuid4().hex[:12]
+        self.tipo = tipo
+        self.descripcion = descripcion
+        self.clave = clave          # dedupe key, see submit()
+        self.estado = "pendiente"   # pendiente -> ejecutando -> completado | error
+        self.procesados = 0
+        self.total = None           # unknown until the job counts its rows
+        self.creado = datetime.now()
+        self.inicio = None
+        self.fin = None
+        self._t0 = None
+        self._t1 = None
+        self.resultado = None
+        self.error = None
+
+    def set_total(self, total: int):
+        self.total = total
+
+    def advance(self, n: int):
+        self.procesados += n
+
+    def to_dict(self) -> dict:
+        elapsed = None
+        if self._t0 is not None:
+            elapsed = (self._t1 if self._t1 is not None else time.monotonic()) - self._t0
+        velocidad = round(self.procesados / elapsed, 1) if elapsed else None
+        eta = None
+        if self.estado == "ejecutando" and self.total and velocidad:
+            eta = round(max(self.total - self.procesados, 0) / velocidad, 1)
+        porcentaje = None
+        if self.total:
+            porcentaje = round(min(self.procesados / self.total, 1) * 100, 1)
+        elif self.estado == "completado":
+            porcentaje = 100.0
+        return {
+            "id": self.id,
+            "tipo": self.tipo,
+            "descripcion": self.descripcion,
+            "estado": self.estado,
+            "procesados": self.procesados,
+            "total": self.total,
+            "porcentaje": porcentaje,
+            "velocidad": velocidad,   # rows per second
+            "eta": eta,               # seconds remaining
+            "creado": self.creado.isoformat(),
+            "inicio": self.inicio.isoformat() if self.inicio else None,
+            "fin": self.fin.isoformat() if self.fin else None,
+            "resultado": self.resultado,
+            "error": self.error,
+        }
+
+
+def _run(job: Job, fn, args):
+    job.estado = "ejecutando"
+    job.inicio = datetime.now()
+    job._t0 = time.monotonic()
+    try:
+        job.resultado = fn(job, *args)
+        job.estado = "completado"
+    except Exception as e:
+        job.error = str(e)
+        job.estado = "error"
+        print(f"[JOB ERROR] {job.tipo} {job.id}: {e}")
+    finally:
+        job._t1 = time.monotonic()
+        job.fin = datetime.now()
+
+
+def submit(tipo: str, descripcion: str, fn, *args, clave: str = None, cola: str = "general") -> Job:
+    """Queue fn(job, *args) on the cola's worker pool; its return value becomes job.resultado.
+
+    With a clave, a job with the same clave that is still pending or running is
+    returned instead of queuing a duplicate.
+    """
+    with _jobs_lock:
+        if clave is not None:
+            for j in jobs.values():
+                if j.clave == clave and j.estado in ("pendiente", "ejecutando"):
+                    return j
+        job = Job(tipo, descripcion, clave)
+        jobs[job.id] = job
+        while len(jobs) > JOBS_MAX:
+            oldest = next(iter(jobs.values()))
+            if oldest.estado in ("pendiente", "ejecutando"):
+                break
+            jobs.popitem(last=False)
+    _executors[cola].submit(_run, job, fn, args)
+    return job
+
+
+def resource_lock(recurso: str) -> Lock:
+    """Lock shared by every job that moves the same rows (e.g. "inventario-12"), so they run one at a time"""
+    with _jobs_lock:
+        return _resource_locks.setdefault(recurso, Lock())
+
+
+def wait_job(job: Job, intervalo: float = 5):
+    """Block until the job has finished (completado or error)"""
+    while job.estado in ("pendiente", "ejecutando"):
+        time.sleep(intervalo)
+
+
+def get_job(job_id: str):
+    return jobs.get(job_id)
+
+
+def list_jobs() -> list:
+    """Jobs newest first"""
+    with _jobs_lock:
+        return [j.to_dict() for j in reversed(jobs.values())]
@@ -9,12 +9,22 @@ from datetime import datetime
 from collections import deque
 from sqlalchemy.orm import Session
 from sqlalchemy import text
-from database import get_db, get_retail_db, init_tables
+from database import get_db, get_retail_db, init_tables, SessionFerrini, SessionRetail, delete_chunked
+from database import engine_ferrini, engine_retail, start_pool_manager, pool_status, ensure_archivo_table
+from fastjson import json_response, stream_rows
+from profiling import ProfiledRoute, ProfileMiddleware, PROFILING_ENABLED, install_slow_query_log, profiles, slow_queries, get_profile, fetch_all
+from jobs import Job, submit as submit_job, wait_job, get_job, list_jobs, resource_lock
+from reporte import build_reporte, iter_reconciliacion, totales_por_dispositivo, get_resumen_entry, drill_down, DIMENSIONES
+from archive import load_archivo, is_archivado, archivar_inventario, restaurar_inventario, pendientes_archivo, lock_cabecera, ARCHIVE_INTERVAL_MINUTES
 import os
 import hashlib
 import json
+import threading
+import time
 
 app = FastAPI(title="Inventario API", version="2.0.0")
+# Must be set before any route is declared (see profiling.py)
+app.router.route_class = ProfiledRoute
 
 # GZip compression for large responses (like maestra)
 app.add_middleware(GZipMiddleware, minimum_size=1000)
@@ -40,6 +50,12 @@ app.add_middleware(
     allow_headers=["Content-Type"],
 )
 
+# Opt-in profiling (PROFILE_SAMPLE_RATE / PROFILE_TOKEN) and slow-query log (SLOW_QUERY_MS)
+if PROFILING_ENABLED:
+    app.add_middleware(ProfileMiddleware)
+install_slow_query_log(engine_ferrini, "DBFERRINI")
+install_slow_query_log(engine_retail, "RetailDataSHOE")
+
 # Cache for maestra to avoid hitting DB every time
 maestra_cache = {
     "data": None,
@@ -62,7 +78,8 @@ def log_admin(tipo: str, mensaje: str, usuario: str = "sistema"):
 @app.on_event("startup")
 def startup():
     # init_tables()  # Disabled: lazy load on first request (avoids SSL errors on startup)
-    pass
+    start_pool_manager()
+    threading.Thread(target=_archive_scheduler, name="archive-scheduler", daemon=True).start()
 
 # Serve PDA web app — accessible from any browser via VPS
 # http://190.187.176.69:8001/app  (same as APK but in browser, no Honeywell scanner)
@@ -167,7 +184,7 @@ def load_maestra_from_db(retail_db: Session):
         WHERE isnull(p.ALU,'-1')<>'-1' AND LEN(p.ALU)=17
         ORDER BY 1
     """)
-    rows = retail_db.execute(query).mappings().all()
+    rows = fetch_all(retail_db.execute(query), mappings=True)
     data = [dict(r) for r in rows]
 
     # Calculate hash for versioning
@@ -194,19 +211,29 @@ def get_maestra_version(retail_db: Session = Depends(get_retail_db)):
     }
 
 
-@app.post("/api/maestra/refresh")
-def refresh_maestra(retail_db: Session = Depends(get_retail_db)):
-    """Force refresh maestra cache from database"""
-    data, data_hash = load_maestra_from_db(retail_db)
+def _refresh_maestra_job(job: Job):
+    retail_db = SessionRetail()
+    try:
+        data, data_hash = load_maestra_from_db(retail_db)
+    finally:
+        retail_db.close()
+    job.set_total(len(data))
+    job.advance(len(data))
     log_admin("maestra", f"Maestra actualizada: {len(data):,} productos (hash: {data_hash})")
     return {
-        "success": True,
         "hash": data_hash,
         "count": len(data),
         "message": f"Maestra actualizada: {len(data):,} productos"
     }
 
 
+@app.post("/api/maestra/refresh")
+def refresh_maestra():
+    """Force refresh maestra cache from database (background job, poll /api/jobs/{id})"""
+    job = submit_job("maestra", "Actualizar maestra", _refresh_maestra_job)
+    return {"success": True, "job_id": job.id, "message": "Actualizando maestra..."}
+
+
 @app.get("/api/maestra")
 def get_maestra(retail_db: Session = Depends(get_retail_db)):
     """Get full maestra - uses cache if available"""
@@ -217,16 +244,18 @@ def get_maestra(retail_db: Session = Depends(get_retail_db)):
 
 # --- Inventarios ---
 @app.get("/api/inventarios")
-def list_inventarios(db: Session = Depends(get_db)):
+def list_inventarios():
+    ensure_archivo_table()
     query = text("""
         SELECT c.Id, c.CodTienda, c.NombreTienda, c.FechaCreacion, c.Estado,
-            (SELECT COUNT(*) FROM INV_STOCK_TEORICO WHERE IdInventario=c.Id) as TotalStock,
-            (SELECT ISNULL(SUM(Cantidad),0) FROM INV_LECTURAS WHERE IdInventario=c.Id) as TotalLecturas
+            CASE WHEN a.IdInventario IS NULL THEN 0 ELSE 1 END as Archivado,
+            ISNULL(a.TotalStock, (SELECT COUNT(*) FROM INV_STOCK_TEORICO WHERE IdInventario=c.Id)) as TotalStock,
+            ISNULL(a.TotalLecturas, (SELECT ISNULL(SUM(Cantidad),0) FROM INV_LECTURAS WHERE IdInventario=c.Id)) as TotalLecturas
         FROM INV_CABECERA c
+        LEFT JOIN INV_ARCHIVO a ON a.IdInventario = c.Id
         ORDER BY c.FechaCreacion DESC
     """)
-    rows = db.execute(query).mappings().all()
-    return [dict(r) for r in rows]
+    return stream_rows(SessionFerrini(), query)
 
 
 @app.get("/api/inventario/activo")
@@ -242,57 +271,112 @@ def get_inventario_activo(db: Session = Depends(get_db)):
     return {"activo": True, "inventario": dict(row)}
 
 
-@app.post("/api/inventario")
-def crear_inventario(req: CrearInventarioRequest, db: Session = Depends(get_db),
-                     retail_db: Session = Depends(get_retail_db)):
-    insert_q = text("""
-        INSERT INTO INV_CABECERA (CodTienda, NombreTienda)
-        OUTPUT INSERTED.Id
-        VALUES (:cod, :nombre)
-    """)
-    result = db.execute(insert_q, {"cod": req.cod_tienda, "nombre": req.nombre_tienda})
-    inv_id = result.scalar()
-
-    stock_q = text("""
-        SELECT p.sku, p.ALU, s.OnHandQty as cantidad,
-            (SELECT deptname FROM DEPARTMENT WHERE DeptCode=t.DeptCode) as departamento,
-            t.Desc1 as modelo, t.Desc2 as proveedor, t.Desc3 as temporada,
-            t.Desc1+' '+ISNULL(c.ColorLongName,'')+' '+ISNULL(p.SizeCode,'') as descripcion
-        FROM PRODUCT_STORE s
-        INNER JOIN PRODUCT p ON s.SKU=p.sku
-        INNER JOIN PRODUCT_STYLE t ON p.StyleCode=t.StyleCode
-        LEFT JOIN COLOR c ON p.ColorCode=c.ColorCode
-        WHERE StoreNo=:tienda AND OnHandQty>0
-        ORDER BY 4
-    """)
-    rows = retail_db.execute(stock_q, {"tienda": req.cod_tienda}).mappings().all()
+# Rows per INSERT batch when loading stock teorico (one round trip each: engine_ferrini
+# uses fast_executemany)
+JOB_CHUNK = 4000
 
-    for r in rows:
-        db.execute(text("""
+
+def _crear_inventario_job(job: Job, cod_tienda: str, nombre_tienda: str):
+    db = SessionFerrini()
+    retail_db = SessionRetail()
+    inv_id = None
+    lock = None
+    try:
+        stock_q = text("""
+            SELECT p.sku, p.ALU, s.OnHandQty as cantidad,
+                (SELECT deptname FROM DEPARTMENT WHERE DeptCode=t.DeptCode) as departamento,
+                t.Desc1 as modelo, t.Desc2 as proveedor, t.Desc3 as temporada,
+                t.Desc1+' '+ISNULL(c.ColorLongName,'')+' '+ISNULL(p.SizeCode,'') as descripcion
+            FROM PRODUCT_STORE s
+            INNER JOIN PRODUCT p ON s.SKU=p.sku
+            INNER JOIN PRODUCT_STYLE t ON p.StyleCode=t.StyleCode
+            LEFT JOIN COLOR c ON p.ColorCode=c.ColorCode
+            WHERE StoreNo=:tienda AND OnHandQty>0
+            ORDER BY 4
+        """)
+        rows = fetch_all(retail_db.execute(stock_q, {"tienda": cod_tienda}), mappings=True)
+        job.set_total(len(rows))
+
+        # 'cargando' until the last chunk is in: iniciar and sync reject it, so nobody
+        # opens or counts against a partial stock teorico
+        insert_q = text("""
+            INSERT INTO INV_CABECERA (CodTienda, NombreTienda, Estado)
+            OUTPUT INSERTED.Id
+            VALUES (:cod, :nombre, 'cargando')
+        """)
+        inv_id = db.execute(insert_q, {"cod": cod_tienda, "nombre": nombre_tienda}).scalar()
+        # Taken before the header is visible, so a DELETE of this inventory waits for the load
+        lock = resource_lock(f"inventario-{inv_id}")
+        lock.acquire()
+        db.commit()
+
+        stock_insert = text("""
             INSERT INTO INV_STOCK_TEORICO
                 (IdInventario, SKU, ALU, Descripcion, Departamento, Modelo, Proveedor, Temporada, StockTeorico)
             VALUES (:inv_id, :sku, :alu, :desc, :dept, :modelo, :prov, :temp, :stock)
-        """), {
-            "inv_id": inv_id, "sku": r["sku"], "alu": r["ALU"],
-            "desc": r["descripcion"], "dept": r["departamento"],
-            "modelo": r["modelo"], "prov": r["proveedor"],
-            "temp": r["temporada"], "stock": r["cantidad"]
-        })
+        """)
+        for i in range(0, len(rows), JOB_CHUNK):
+            chunk = rows[i:i + JOB_CHUNK]
+            db.execute(stock_insert, [{
+                "inv_id": inv_id, "sku": r["sku"], "alu": r["ALU"],
+                "desc": r["descripcion"], "dept": r["departamento"],
+                "modelo": r["modelo"], "prov": r["proveedor"],
+                "temp": r["temporada"], "stock": r["cantidad"]
+            } for r in chunk])
+            db.commit()
+            job.advance(len(chunk))
+        db.execute(text("UPDATE INV_CABECERA SET Estado = 'preparacion' WHERE Id = :id AND Estado = 'cargando'"),
+                   {"id": inv_id})
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        if inv_id is not None:
+            # Don't leave a half-loaded inventory behind (if this fails too, it stays
+            # 'cargando' and DELETE /api/inventario/{id} removes it)
+            try:
+                db.execute(text("DELETE FROM INV_STOCK_TEORICO WHERE IdInventario = :id"), {"id": inv_id})
+                db.execute(text("DELETE FROM INV_CABECERA WHERE Id = :id"), {"id": inv_id})
+                db.commit()
+            except Exception:
+                db.rollback()
+        log_admin("error", f"Error creando inventario {nombre_tienda} ({cod_tienda}): {e}")
+        raise
+    finally:
+        if lock is not None:
+            lock.release()
+        db.close()
+        retail_db.close()
+
+    log_admin("inventario", f"Inventario #{inv_id} creado: {nombre_tienda} ({cod_tienda}), {len(rows)} productos cargados")
+    return {"inventario_id": inv_id, "productos_cargados": len(rows)}
 
-    db.commit()
-    log_admin("inventario", f"Inventario #{inv_id} creado: {req.nombre_tienda} ({req.cod_tienda}), {len(rows)} productos cargados")
-    return {"success": True, "inventario_id": inv_id, "productos_cargados": len(rows)}
+
+@app.post("/api/inventario")
+def crear_inventario(req: CrearInventarioRequest):
+    """Create inventory + load stock teorico (background job, poll /api/jobs/{id})"""
+    job = submit_job("crear-inventario", f"Crear inventario {req.nombre_tienda} ({req.cod_tienda})",
+                     _crear_inventario_job, req.cod_tienda, req.nombre_tienda)
+    return {"success": True, "job_id": job.id}
 
 
 @app.get("/api/inventario/{inv_id}/stock")
-def get_stock(inv_id: int, db: Session = Depends(get_db)):
-    query = text("""
-        SELECT Id, SKU, ALU, Descripcion, Departamento, Modelo, Proveedor, Temporada, StockTeorico
-        FROM INV_STOCK_TEORICO WHERE IdInventario = :inv_id
-        ORDER BY Departamento, Modelo
-    """)
-    rows = db.execute(query, {"inv_id": inv_id}).mappings().all()
-    return [dict(r) for r in rows]
+def get_stock(inv_id: int):
+    # One session (one pooled connection) for the archive check and the stream
+    db = SessionFerrini()
+    try:
+        archivado = load_archivo(db, inv_id, "Stock")
+        if archivado is None:
+            query = text("""
+                SELECT Id, SKU, ALU, Descripcion, Departamento, Modelo, Proveedor, Temporada, StockTeorico
+                FROM INV_STOCK_TEORICO WHERE IdInventario = :inv_id
+                ORDER BY Departamento, Modelo
+            """)
+            return stream_rows(db, query, {"inv_id": inv_id})  # closes db after the body
+    except Exception:
+        db.close()
+        raise
+    db.close()
+    return json_response(archivado)
 
 
 @app.delete("/api/inventario/{inv_id}/stock/{stock_id}")
@@ -303,11 +387,49 @@ def delete_stock(inv_id: int, stock_id: int, db: Session = Depends(get_db)):
     return {"success": True}
 
 
-@app.put("/api/inventario/{inv_id}/iniciar")
-def iniciar_inventario(inv_id: int, db: Session = Depends(get_db)):
+def _activar_inventario(db: Session, inv_id: int):
     db.execute(text("UPDATE INV_CABECERA SET Estado = 'cerrado' WHERE Estado = 'activo' AND Id != :id"),
                {"id": inv_id})
     db.execute(text("UPDATE INV_CABECERA SET Estado = 'activo' WHERE Id = :id"), {"id": inv_id})
+
+
+def _restaurar_inventario_job(job: Job, inv_id: int):
+    db = SessionFerrini()
+    try:
+        with resource_lock(f"inventario-{inv_id}"):
+            result = restaurar_inventario(db, inv_id, job.set_total, job.advance)
+            # Un-archive and reopen in one commit: PDAs can only sync once the rows are back
+            _activar_inventario(db, inv_id)
+            db.commit()
+    except Exception as e:
+        db.rollback()
+        log_admin("error", f"Error restaurando inventario #{inv_id}: {e}")
+        raise
+    finally:
+        db.close()
+    log_admin("inventario", f"Inventario #{inv_id} restaurado del archivo ({result['stock']} stock, {result['lecturas']} lecturas) e iniciado (estado: activo)")
+    return result
+
+
+@app.put("/api/inventario/{inv_id}/iniciar")
+def iniciar_inventario(inv_id: int, db: Session = Depends(get_db)):
+    ensure_archivo_table()
+    # Header locked first: the archive job inserts its row under the same lock, so either
+    # it sees 'activo' and gives up, or we see the archive row and restore it
+    estado = lock_cabecera(db, inv_id)
+    if estado is None:
+        db.rollback()
+        raise HTTPException(status_code=404, detail="Inventario no encontrado")
+    if estado in ("cargando", "eliminando"):
+        db.rollback()
+        raise HTTPException(status_code=409, detail=f"Inventario #{inv_id} no se puede iniciar (estado: {estado})")
+    if is_archivado(db, inv_id):
+        db.rollback()
+        # Reopening an archived inventory brings its rows back to the hot tables (background job)
+        job = submit_job("restaurar-inventario", f"Restaurar inventario #{inv_id}",
+                         _restaurar_inventario_job, inv_id, clave=f"restaurar-{inv_id}", cola="archivo")
+        return {"success": True, "job_id": job.id}
+    _activar_inventario(db, inv_id)
     db.commit()
     log_admin("inventario", f"Inventario #{inv_id} iniciado (estado: activo)")
     return {"success": True}
@@ -315,15 +437,23 @@ def iniciar_inventario(inv_id: int, db: Session = Depends(get_db)):
 
 @app.post("/api/inventario/{inv_id}/sync")
 def sync_lecturas(inv_id: int, req: SyncRequest, db: Session = Depends(get_db)):
+    # Shared lock held until commit: other PDAs' syncs run alongside, closing/archiving
+    # waits for an in-flight sync, and a sync never lands in a closed inventory
+    estado = lock_cabecera(db, inv_id, compartido=True)
+    if estado != "activo":
+        db.rollback()
+        raise HTTPException(status_code=409, detail=f"Inventario #{inv_id} no esta activo (estado: {estado})")
     try:
         db.execute(text("DELETE FROM INV_LECTURAS WHERE IdInventario = :inv AND Dispositivo = :dev"),
                    {"inv": inv_id, "dev": str(req.dispositivo)})
 
-        for item in req.lecturas:
+        # One executemany (a single round trip with fast_executemany) instead of one
+        # INSERT per lectura, so the header lock is held for as short as possible
+        if req.lecturas:
             db.execute(text("""
                 INSERT INTO INV_LECTURAS (IdInventario, SKU, ALU, Descripcion, Cantidad, Ubicacion, Dispositivo, Origen)
                 VALUES (:inv, :sku, :alu, :desc, :qty, :ubi, :dev, :origen)
-            """), {
+            """), [{
                 "inv": inv_id,
                 "sku": str(item.sku or ''),
                 "alu": str(item.alu or ''),
@@ -332,7 +462,7 @@ def sync_lecturas(inv_id: int, req: SyncRequest, db: Session = Depends(get_db)):
                 "ubi": str(item.ubicacion or ''),
                 "dev": str(req.dispositivo),
                 "origen": str(item.origen or 'scanner')[:10]
-            })
+            } for item in req.lecturas])
 
         db.commit()
         total_qty = sum(int(i.cantidad or 1) for i in req.lecturas)
@@ -359,22 +489,30 @@ def sync_lecturas(inv_id: int, req: SyncRequest, db: Session = Depends(get_db)):
 
 
 @app.get("/api/inventario/{inv_id}/lecturas")
-def get_lecturas(inv_id: int, dispositivo: str = Query(None), db: Session = Depends(get_db)):
-    if dispositivo:
-        query = text("""
-            SELECT Id, SKU, ALU, Descripcion, Cantidad, Ubicacion, Dispositivo, ISNULL(Origen,'scanner') as Origen, FechaHora
-            FROM INV_LECTURAS WHERE IdInventario = :inv AND Dispositivo = :dev
-            ORDER BY FechaHora DESC
-        """)
-        rows = db.execute(query, {"inv": inv_id, "dev": dispositivo}).mappings().all()
-    else:
-        query = text("""
-            SELECT Id, SKU, ALU, Descripcion, Cantidad, Ubicacion, Dispositivo, ISNULL(Origen,'scanner') as Origen, FechaHora
-            FROM INV_LECTURAS WHERE IdInventario = :inv
-            ORDER BY FechaHora DESC
-        """)
-        rows = db.execute(query, {"inv": inv_id}).mappings().all()
-    return [dict(r) for r in rows]
+def get_lecturas(inv_id: int, dispositivo: str = Query(None)):
+    # One session (one pooled connection) for the archive check and the stream
+    db = SessionFerrini()
+    try:
+        archivado = load_archivo(db, inv_id, "Lecturas")
+        if archivado is None:
+            if dispositivo:
+                query = text("""
+                    SELECT Id, SKU, ALU, Descripcion, Cantidad, Ubicacion, Dispositivo, ISNULL(Origen,'scanner') as Origen, FechaHora
+                    FROM INV_LECTURAS WHERE IdInventario = :inv AND Dispositivo = :dev
+                    ORDER BY FechaHora DESC
+                """)
+                return stream_rows(db, query, {"inv": inv_id, "dev": dispositivo})  # closes db after the body
+            query = text("""
+                SELECT Id, SKU, ALU, Descripcion, Cantidad, Ubicacion, Dispositivo, ISNULL(Origen,'scanner') as Origen, FechaHora
+                FROM INV_LECTURAS WHERE IdInventario = :inv
+                ORDER BY FechaHora DESC
+            """)
+            return stream_rows(db, query, {"inv": inv_id})
+    except Exception:
+        db.close()
+        raise
+    db.close()
+    return json_response([l for l in archivado if l["Dispositivo"] == dispositivo] if dispositivo else archivado)
 
 
 @app.delete("/api/inventario/{inv_id}/lecturas/{lectura_id}")
@@ -388,175 +526,69 @@ def delete_lectura(inv_id: int, lectura_id: int, db: Session = Depends(get_db)):
 @app.get("/api/inventario/{inv_id}/reporte")
 def get_reporte(inv_id: int, db: Session = Depends(get_db),
                 retail_db: Session = Depends(get_retail_db)):
-    stock_rows = db.execute(text("""
-        SELECT SKU, ALU, Descripcion, Departamento, Modelo, Proveedor, StockTeorico
-        FROM INV_STOCK_TEORICO WHERE IdInventario = :inv
-    """), {"inv": inv_id}).mappings().all()
-
-    lecturas_rows = db.execute(text("""
-        SELECT SKU, SUM(Cantidad) as Conteo
-        FROM INV_LECTURAS WHERE IdInventario = :inv
-        GROUP BY SKU
-    """), {"inv": inv_id}).mappings().all()
-    conteo_map = {r["SKU"]: r["Conteo"] for r in lecturas_rows}
-
-    # Join PRODUCT_STYLE to get Proveedor (Desc2) — same source as Maestra, guaranteed correct
-    precios_rows = retail_db.execute(text("""
-        SELECT p.SKU,
-            (CASE WHEN p.AvgCost = 0 THEN p.lastcost ELSE p.avgcost END) as Costo,
-            p.RetailPrice as Precio,
-            ISNULL(t.Desc2, '') as Proveedor
-        FROM PRODUCT p
-        LEFT JOIN PRODUCT_STYLE t ON p.StyleCode = t.StyleCode
-    """)).mappings().all()
-    # str() on SKU to avoid int/varchar type mismatch in dict lookup
-    precios_map = {str(r["SKU"]): {
-        "costo": float(r["Costo"] or 0),
-        "precio": float(r["Precio"] or 0),
-        "proveedor": str(r["Proveedor"] or "")
-    } for r in precios_rows}
-
-    reporte = []
-    stock_skus = set()
-    for s in stock_rows:
-        sku = str(s["SKU"])
-        stock_skus.add(sku)
-        conteo = conteo_map.get(s["SKU"], 0) or conteo_map.get(sku, 0)
-        diff = conteo - s["StockTeorico"]
-        p = precios_map.get(sku, {"costo": 0, "precio": 0, "proveedor": ""})
-        reporte.append({
-            "SKU": sku, "ALU": s["ALU"], "Descripcion": s["Descripcion"],
-            "Departamento": s["Departamento"], "Modelo": s["Modelo"],
-            "Proveedor": p["proveedor"],  # from RetailDataSHOE (same source as Maestra)
-            "StockTeorico": s["StockTeorico"], "Conteo": conteo,
-            "Diferencia": diff, "Costo": p["costo"], "Precio": p["precio"],
-            "DifCosto": round(diff * p["costo"], 2),
-            "DifPrecio": round(diff * p["precio"], 2),
-            "Sobrante": False
-        })
-
-    extras = db.execute(text("""
-        SELECT SKU, ALU, Descripcion, SUM(Cantidad) as Conteo
-        FROM INV_LECTURAS WHERE IdInventario = :inv
-        GROUP BY SKU, ALU, Descripcion
-    """), {"inv": inv_id}).mappings().all()
-
-    # For sobrantes: look up real department and proveedor from RetailDataSHOE
-    extra_skus = [l["SKU"] for l in extras if l["SKU"] not in stock_skus]
-    extra_info = {}
-    if extra_skus:
-        placeholders = ",".join(f"'{sku}'" for sku in extra_skus)
-        extra_rows = retail_db.execute(text(f"""
-            SELECT p.SKU,
-                (SELECT deptname FROM DEPARTMENT WHERE DeptCode=t.DeptCode) as Departamento,
-                t.Desc2 as Proveedor
-            FROM PRODUCT p
-            INNER JOIN PRODUCT_STYLE t ON p.StyleCode=t.StyleCode
-            WHERE p.SKU IN ({placeholders})
-        """)).mappings().all()
-        for er in extra_rows:
-            extra_info[er["SKU"]] = {"Departamento": er["Departamento"] or "", "Proveedor": er["Proveedor"] or ""}
-
-    for l in extras:
-        if l["SKU"] not in stock_skus:
-            p = precios_map.get(l["SKU"], {"costo": 0, "precio": 0})
-            info = extra_info.get(l["SKU"], {"Departamento": "", "Proveedor": ""})
-            reporte.append({
-                "SKU": l["SKU"], "ALU": l["ALU"], "Descripcion": l["Descripcion"],
-                "Departamento": info["Departamento"], "Modelo": "",
-                "Proveedor": info["Proveedor"],
-                "StockTeorico": 0, "Conteo": l["Conteo"],
-                "Diferencia": l["Conteo"], "Costo": p["costo"], "Precio": p["precio"],
-                "DifCosto": round(l["Conteo"] * p["costo"], 2),
-                "DifPrecio": round(l["Conteo"] * p["precio"], 2),
-                "Sobrante": True
-            })
+    return json_response(build_reporte(db, retail_db, inv_id))
+
+
+@app.get("/api/inventario/{inv_id}/reporte/resumen")
+def get_reporte_resumen(inv_id: int, db: Session = Depends(get_db),
+                        retail_db: Session = Depends(get_retail_db)):
+    """Totals grouped by departamento, proveedor, modelo and tipo (exceso/falta/cuadrado) - cached per version"""
+    return get_resumen_entry(db, retail_db, inv_id)["resumen"]
+
 
-    return reporte
+@app.get("/api/inventario/{inv_id}/reporte/resumen/{dimension}")
+def get_reporte_grupo(inv_id: int, dimension: str, grupo: str = Query(""),
+                      page: int = Query(1, ge=1), page_size: int = Query(100, ge=1, le=1000),
+                      db: Session = Depends(get_db), retail_db: Session = Depends(get_retail_db)):
+    """Drill-down: report rows of one group, paginated"""
+    if dimension not in DIMENSIONES:
+        raise HTTPException(status_code=400, detail=f"Dimension invalida: {dimension}")
+    entry = get_resumen_entry(db, retail_db, inv_id)
+    return drill_down(entry, dimension, grupo, page, page_size)
 
 
 @app.get("/api/inventario/{inv_id}/progreso")
 def get_progreso(inv_id: int, db: Session = Depends(get_db)):
     """Get inventory progress: stock vs count with device breakdown"""
-    # 1. Stock teorico
-    stock_rows = db.execute(text("""
-        SELECT SKU, ALU, Descripcion, Departamento, Modelo, Proveedor, Temporada, StockTeorico
-        FROM INV_STOCK_TEORICO WHERE IdInventario = :inv
-        ORDER BY Departamento, Modelo
-    """), {"inv": inv_id}).mappings().all()
-
-    # 2. Conteo agrupado por SKU
-    conteo_rows = db.execute(text("""
-        SELECT SKU, SUM(Cantidad) as Conteo
-        FROM INV_LECTURAS WHERE IdInventario = :inv
-        GROUP BY SKU
-    """), {"inv": inv_id}).mappings().all()
-    conteo_map = {r["SKU"]: r["Conteo"] for r in conteo_rows}
-
-    # 3. Totales por dispositivo
-    device_rows = db.execute(text("""
-        SELECT Dispositivo, SUM(Cantidad) as Total
-        FROM INV_LECTURAS WHERE IdInventario = :inv
-        GROUP BY Dispositivo
-    """), {"inv": inv_id}).mappings().all()
-    por_dispositivo = {r["Dispositivo"]: r["Total"] for r in device_rows}
-
-    # 4. Build products list and calculate totals
+    archivo = load_archivo(db, inv_id, "Resumen")
+    if archivo is not None:
+        por_dispositivo = archivo["porDispositivo"]
+        filas = archivo["productos"]
+    else:
+        por_dispositivo = totales_por_dispositivo(db, inv_id)
+        # Stock vs conteo (sobrantes included) in a single query, streamed from the cursor
+        filas = iter_reconciliacion(db, inv_id)
+
     total_stock = 0
     total_conteo = 0
+    total_productos = 0
     productos_contados = 0
     productos = []
-    stock_skus = set()
-
-    for s in stock_rows:
-        sku = s["SKU"]
-        stock_skus.add(sku)
-        conteo = conteo_map.get(sku, 0)
-        diff = conteo - s["StockTeorico"]
-        total_stock += s["StockTeorico"]
+
+    for f in filas:
+        conteo = f["Conteo"]
         total_conteo += conteo
         if conteo > 0:
             productos_contados += 1
-        productos.append({
-            "SKU": sku, "ALU": s["ALU"], "Descripcion": s["Descripcion"],
-            "Departamento": s["Departamento"], "Modelo": s["Modelo"],
-            "Proveedor": s["Proveedor"], "Temporada": s["Temporada"],
-            "StockTeorico": s["StockTeorico"], "Conteo": conteo, "Diferencia": diff,
-            "Sobrante": False
-        })
-
-    # 5. Add sobrantes (lecturas not in stock teorico)
-    sobrantes_rows = db.execute(text("""
-        SELECT SKU, ALU, Descripcion, SUM(Cantidad) as Conteo
-        FROM INV_LECTURAS WHERE IdInventario = :inv
-        GROUP BY SKU, ALU, Descripcion
-    """), {"inv": inv_id}).mappings().all()
-
-    for l in sobrantes_rows:
-        if l["SKU"] not in stock_skus:
-            conteo = l["Conteo"]
-            total_conteo += conteo
-            productos_contados += 1
-            productos.append({
-                "SKU": l["SKU"], "ALU": l["ALU"], "Descripcion": l["Descripcion"],
-                "Departamento": "", "Modelo": "", "Proveedor": "", "Temporada": "",
-                "StockTeorico": 0, "Conteo": conteo, "Diferencia": conteo,
-                "Sobrante": True
-            })
+        if not f["Sobrante"]:
+            total_stock += f["StockTeorico"]
+            total_productos += 1
+        f["Diferencia"] = conteo - f["StockTeorico"]
+        productos.append(f)
 
     porcentaje = round(total_conteo / total_stock * 100, 1) if total_stock > 0 else 0
 
-    return {
+    return json_response({
         "resumen": {
             "totalStock": total_stock,
             "totalConteo": total_conteo,
             "porcentaje": porcentaje,
-            "totalProductos": len(stock_rows),
+            "totalProductos": total_productos,
             "productosContados": productos_contados
         },
         "porDispositivo": por_dispositivo,
         "productos": productos
-    }
+    })
 
 
 @app.put("/api/inventario/{inv_id}/cerrar")
@@ -564,17 +596,117 @@ def cerrar_inventario(inv_id: int, db: Session = Depends(get_db)):
     db.execute(text("UPDATE INV_CABECERA SET Estado = 'cerrado' WHERE Id = :id"), {"id": inv_id})
     db.commit()
     log_admin("inventario", f"Inventario #{inv_id} cerrado")
-    return {"success": True}
+    job = submit_archivo(inv_id)
+    return {"success": True, "job_id": job.id}
+
+
+# --- Archivo (closed inventories out of the hot tables) ---
+def _archivar_inventario_job(job: Job, inv_id: int):
+    db = SessionFerrini()
+    retail_db = SessionRetail()
+
+    def materializar():
+        # What the read endpoints need once the hot rows are gone
+        resumen = {
+            "porDispositivo": totales_por_dispositivo(db, inv_id),
+            "productos": list(iter_reconciliacion(db, inv_id)),
+            "reporte": build_reporte(db, retail_db, inv_id),
+        }
+        job.set_total(len(resumen["productos"]))
+        return resumen
+
+    try:
+        with resource_lock(f"inventario-{inv_id}"):
+            result = archivar_inventario(db, inv_id, materializar, job.advance)
+    except Exception as e:
+        db.rollback()
+        log_admin("error", f"Error archivando inventario #{inv_id}: {e}")
+        raise
+    finally:
+        db.close()
+        retail_db.close()
+    log_admin("inventario", f"Inventario #{inv_id} archivado ({result['borrados']:,} filas fuera de las tablas activas)")
+    return result
+
+
+def submit_archivo(inv_id: int) -> Job:
+    # cerrar, /archivar and the scheduler may all ask for the same inventory: one job at a time
+    return submit_job("archivar-inventario", f"Archivar inventario #{inv_id}",
+                      _archivar_inventario_job, inv_id, clave=f"archivar-{inv_id}", cola="archivo")
+
+
+@app.post("/api/inventario/{inv_id}/archivar")
+def archivar(inv_id: int):
+    """Archive a closed inventory now (background job, poll /api/jobs/{id})"""
+    job = submit_archivo(inv_id)
+    return {"success": True, "job_id": job.id}
+
+
+def _archive_scheduler():
+    """Periodically archive closed inventories that skipped cerrar (e.g. auto-closed by iniciar)"""
+    while True:
+        time.sleep(ARCHIVE_INTERVAL_MINUTES * 60)
+        db = SessionFerrini()
+        try:
+            pendientes = pendientes_archivo(db)
+        except Exception as e:
+            print(f"[ARCHIVE SCHEDULER ERROR] {e}")
+            continue
+        finally:
+            db.close()
+        # One at a time: a backlog (e.g. the first sweep after deploy) never queues more
+        # than one archive ahead of a restore the admin is waiting for
+        for inv_id in pendientes:
+            wait_job(submit_archivo(inv_id))
+
+
+def _eliminar_inventario_job(job: Job, inv_id: int, estado_previo: str):
+    db = SessionFerrini()
+    try:
+        ensure_archivo_table()
+        with resource_lock(f"inventario-{inv_id}"):
+            counts = db.execute(text("""
+                SELECT (SELECT COUNT(*) FROM INV_LECTURAS WHERE IdInventario = :id) as Lecturas,
+                    (SELECT COUNT(*) FROM INV_STOCK_TEORICO WHERE IdInventario = :id) as Stock
+            """), {"id": inv_id}).first()
+            job.set_total(counts.Lecturas + counts.Stock)
+            delete_chunked(db, "INV_LECTURAS", inv_id, job.advance)
+            delete_chunked(db, "INV_STOCK_TEORICO", inv_id, job.advance)
+            db.execute(text("DELETE FROM INV_ARCHIVO WHERE IdInventario = :id"), {"id": inv_id})
+            db.execute(text("DELETE FROM INV_CABECERA WHERE Id = :id"), {"id": inv_id})
+            db.commit()
+    except Exception as e:
+        db.rollback()
+        # Put the header back so the inventory isn't stuck in 'eliminando'; the chunks already
+        # deleted stay deleted, and DELETE /api/inventario/{id} again finishes the job
+        try:
+            db.execute(text("UPDATE INV_CABECERA SET Estado = :estado WHERE Id = :id AND Estado = 'eliminando'"),
+                       {"estado": estado_previo, "id": inv_id})
+            db.commit()
+        except Exception:
+            db.rollback()
+        log_admin("error", f"Error eliminando inventario #{inv_id} (vuelve a '{estado_previo}', reintente eliminar): {e}")
+        raise
+    finally:
+        db.close()
+    log_admin("delete", f"Inventario #{inv_id} eliminado (stock + lecturas borrados)")
+    return {"inventario_id": inv_id, "eliminados": job.procesados}
 
 
 @app.delete("/api/inventario/{inv_id}")
 def eliminar_inventario(inv_id: int, db: Session = Depends(get_db)):
-    db.execute(text("DELETE FROM INV_LECTURAS WHERE IdInventario = :id"), {"id": inv_id})
-    db.execute(text("DELETE FROM INV_STOCK_TEORICO WHERE IdInventario = :id"), {"id": inv_id})
-    db.execute(text("DELETE FROM INV_CABECERA WHERE Id = :id"), {"id": inv_id})
+    """Delete inventory with all its stock and lecturas (background job, poll /api/jobs/{id})"""
+    estado = db.execute(text("SELECT Estado FROM INV_CABECERA WHERE Id = :id"), {"id": inv_id}).scalar()
+    if estado is None:
+        raise HTTPException(status_code=404, detail=f"Inventario #{inv_id} no existe")
+    # Flag it first so the list shows it is going away while the chunks are deleted
+    db.execute(text("UPDATE INV_CABECERA SET Estado = 'eliminando' WHERE Id = :id"), {"id": inv_id})
     db.commit()
-    log_admin("delete", f"Inventario #{inv_id} eliminado (stock + lecturas borrados)")
-    return {"success": True}
+    # A retry after a failed delete finds 'eliminando'; fall back to 'cerrado' rather than keep it
+    previo = estado if estado != "eliminando" else "cerrado"
+    job = submit_job("eliminar-inventario", f"Eliminar inventario #{inv_id}",
+                     _eliminar_inventario_job, inv_id, previo, clave=f"eliminar-{inv_id}")
+    return {"success": True, "job_id": job.id}
 
 
 @app.post("/api/inventario/{inv_id}/stock/eliminar-lote")
@@ -595,6 +727,50 @@ def get_admin_log():
     return list(admin_log)
 
 
+# --- Rendimiento (profiles + slow queries) ---
+@app.get("/api/profiles")
+def get_profiles():
+    """Sampled/forced request profiles (newest first, without the stats text)"""
+    return [{k: v for k, v in p.items() if k != "stats"} for p in profiles]
+
+
+@app.get("/api/profiles/{profile_id}")
+def get_profile_detail(profile_id: str):
+    """Full cProfile output of one request"""
+    prof = get_profile(profile_id)
+    if not prof:
+        raise HTTPException(status_code=404, detail="Profile no encontrado")
+    return prof
+
+
+@app.get("/api/pool")
+def get_pool_status():
+    """Connection pool usage per engine"""
+    return pool_status()
+
+
+@app.get("/api/slow-queries")
+def get_slow_queries():
+    """Statements slower than SLOW_QUERY_MS on either engine (newest first, max 200)"""
+    return list(slow_queries)
+
+
+# --- Jobs ---
+@app.get("/api/jobs")
+def get_jobs():
+    """Recent background jobs (newest first)"""
+    return list_jobs()
+
+
+@app.get("/api/jobs/{job_id}")
+def get_job_status(job_id: str):
+    """Progress of a background job: rows processed, rate and ETA"""
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job no encontrado")
+    return job.to_dict()
+
+
 # --- Download APK ---
 @app.get("/download", response_class=HTMLResponse)
 def download_page():
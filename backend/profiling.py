@@ -0,0 +1,298 @@
+"""Opt-in request profiler and slow-query log.
+
+When a store reports slow syncs we need to know whether the time goes to
+Pydantic parsing, the INSERT loop, the ODBC fetch or JSON encoding.
+
+- Request profiles: a fraction of requests (PROFILE_SAMPLE_RATE) or any
+  request carrying the admin token (X-Profile-Token header or ?_profile=)
+  is run under cProfile. Sync endpoints run in the threadpool, so the
+  endpoint itself is profiled in its worker thread (ProfiledRoute) and
+  merged with the event-loop side (parsing, serialization). Streamed
+  bodies (fastjson.stream_rows) are fetched and encoded after the endpoint
+  returns, so each batch is profiled too (profiled_iter) and the profile
+  is only recorded once the last byte is sent. The middleware is plain
+  ASGI and only installed when PROFILE_SAMPLE_RATE or PROFILE_TOKEN is set.
+- Slow queries: every statement on either engine slower than SLOW_QUERY_MS
+  is recorded with its SQL, parameter shape (types only, never values),
+  row count and duration. pyodbc reports rowcount -1 for a SELECT and most
+  of its cost can be the ODBC fetch, so the big reads fetch through
+  iter_timed()/fetch_all(), which add the fetch time and the rows actually
+  fetched to the statement's entry (executeMs + fetchMs = duracionMs).
+  SELECTs fetched some other way are logged on execute time alone.
+"""
+from fastapi import Request
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from contextvars import ContextVar
+from collections import deque
+from datetime import datetime
+from threading import Lock
+import asyncio
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import time
+import uuid
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # 0.0 - 1.0
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")  # empty: forced profiling disabled
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+
+PROFILE_TOP = 60  # functions kept per profile, by cumulative time
+
+# In-memory, newest first (same approach as admin_log)
+profiles: deque = deque(maxlen=50)
+slow_queries: deque = deque(maxlen=200)
+
+_current_profile: ContextVar = ContextVar("current_profile", default=None)
+# cProfile hooks are per thread; two profiled requests on the event loop would clobber each other
+_loop_profiling = False
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, motivo: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.motivo = motivo  # "muestreo" | "admin"
+        self.timestamp = datetime.now()
+        self._lock = Lock()
+        self._profilers = []
+
+    def add(self, profiler: cProfile.Profile):
+        with self._lock:
+            self._profilers.append(profiler)
+
+    def stats_text(self) -> str:
+        out = io.StringIO()
+        with self._lock:
+            profilers = list(self._profilers)
+        stats = None
+        for p in profilers:
+            p.create_stats()
+            if not p.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(p, stream=out)
+            else:
+                stats.add(p)
+        if stats is None:
+            return ""
+        stats.strip_dirs().sort_stats("cumulative").print_stats(PROFILE_TOP)
+        return out.getvalue()
+
+
+def _should_profile(request: Request):
+    if PROFILE_TOKEN:
+        token = request.headers.get("X-Profile-Token") or request.query_params.get("_profile")
+        if token == PROFILE_TOKEN:
+            return "admin"
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "muestreo"
+    return None
+
+
+# Only registered when profiling is configured (see main.py): with the defaults
+# requests don't go through the middleware at all
+PROFILING_ENABLED = PROFILE_SAMPLE_RATE > 0 or bool(PROFILE_TOKEN)
+
+
+class ProfileMiddleware:
+    """Plain ASGI middleware: requests that aren't selected go straight to the app.
+
+    A BaseHTTPMiddleware would pipe every response, and every chunk of a streamed
+    one, through an extra task and memory stream even when nothing is profiled.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _loop_profiling
+        # Never profile the profile viewer itself
+        if scope["type"] != "http" or scope["path"].startswith("/api/profiles"):
+            await self.app(scope, receive, send)
+            return
+        motivo = _should_profile(Request(scope))
+        if motivo is None or _loop_profiling:
+            await self.app(scope, receive, send)
+            return
+
+        _loop_profiling = True
+        prof = RequestProfile(scope["method"], scope["path"], motivo)
+        token = _current_profile.set(prof)
+        status = {"code": None}
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        # Event-loop side: body parsing, validation, jsonable_encoder, JSON rendering.
+        # The app returns only once the body has been sent, so a streamed body's
+        # batches (profiled_iter, worker threads) are in the profile by then too.
+        # Other requests interleaving on the loop also land here; fine for diagnosis.
+        loop_profiler = cProfile.Profile()
+        t0 = time.perf_counter()
+        loop_profiler.enable()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            loop_profiler.disable()
+            _loop_profiling = False
+            _current_profile.reset(token)
+            prof.add(loop_profiler)
+            profiles.appendleft({
+                "id": prof.id,
+                "method": prof.method,
+                "path": prof.path,
+                "motivo": prof.motivo,
+                "status": status["code"],
+                "duracionMs": round((time.perf_counter() - t0) * 1000, 1),
+                "timestamp": prof.timestamp.isoformat(),
+                "stats": prof.stats_text(),
+            })
+
+
+def _profiled(endpoint):
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        prof = _current_profile.get()
+        if prof is None:
+            return endpoint(*args, **kwargs)
+        # cProfile only sees the thread it is enabled in, so profile the worker thread here
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            profiler.disable()
+            prof.add(profiler)
+    return wrapper
+
+
+def profiled_iter(iterable):
+    """Profile each item of a sync body iterator into the current request's profile, if any.
+
+    StreamingResponse pulls every item in a threadpool thread after the endpoint
+    has returned (and cProfile is per thread), so each next() gets its own profiler.
+    """
+    prof = _current_profile.get()
+    if prof is None:
+        return iterable
+    return _profiled_items(iter(iterable), prof)
+
+
+def _profiled_items(it, prof):
+    try:
+        while True:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                profiler.disable()
+                prof.add(profiler)
+            yield item
+    finally:
+        close = getattr(it, "close", None)
+        if close:
+            close()
+
+
+class ProfiledRoute(APIRoute):
+    """APIRoute whose sync endpoints are profiled in their threadpool thread when requested"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if not asyncio.iscoroutinefunction(endpoint):
+            endpoint = _profiled(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+def get_profile(profile_id: str):
+    for p in profiles:
+        if p["id"] == profile_id:
+            return p
+    return None
+
+
+# --- Slow-query log ---
+def _param_shape(parameters, executemany: bool):
+    """Types of the bound parameters, never their values"""
+    if executemany:
+        first = parameters[0] if parameters else ()
+        return {"filas": len(parameters), "tipos": _param_shape(first, False)}
+    if isinstance(parameters, dict):
+        return {k: type(v).__name__ for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(v).__name__ for v in parameters]
+    return type(parameters).__name__
+
+
+def _log_slow(entry: dict):
+    if not any(e is entry for e in slow_queries):
+        slow_queries.appendleft(entry)
+
+
+def install_slow_query_log(engine, nombre: str):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._slow_query_t0 = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        ms = (time.perf_counter() - context._slow_query_t0) * 1000
+        rowcount = getattr(cursor, "rowcount", -1)
+        entry = {
+            "engine": nombre,
+            "sql": " ".join(statement.split())[:2000],
+            "parametros": _param_shape(parameters, executemany),
+            "filas": rowcount if rowcount is not None and rowcount >= 0 else None,
+            "executeMs": round(ms, 1),
+            "fetchMs": None,
+            "duracionMs": round(ms, 1),
+            "timestamp": datetime.now().isoformat(),
+        }
+        if getattr(cursor, "description", None) is not None:
+            # Rows still to be fetched: iter_timed() completes (and maybe logs) the entry
+            context._slow_query_entry = entry
+        if ms >= SLOW_QUERY_MS:
+            _log_slow(entry)
+
+
+def note_fetch(result, filas: int, segundos: float):
+    """Add the fetch of a SELECT to its slow-query entry, logging it if the fetch made it slow"""
+    entry = getattr(getattr(result, "context", None), "_slow_query_entry", None)
+    if entry is None:
+        return
+    entry["filas"] = filas
+    entry["fetchMs"] = round(segundos * 1000, 1)
+    entry["duracionMs"] = round(entry["executeMs"] + entry["fetchMs"], 1)
+    if entry["duracionMs"] >= SLOW_QUERY_MS:
+        _log_slow(entry)
+
+
+def iter_timed(result, mappings: bool = False, size: int = 2000):
+    """Iterate a CursorResult in fetchmany() batches, timing only the fetch (not the consumer)"""
+    source = result.mappings() if mappings else result
+    filas = 0
+    segundos = 0.0
+    while True:
+        t0 = time.perf_counter()
+        rows = source.fetchmany(size)
+        segundos += time.perf_counter() - t0
+        if not rows:
+            break
+        filas += len(rows)
+        yield from rows
+    note_fetch(result, filas, segundos)
+
+
+def fetch_all(result, mappings: bool = False) -> list:
+    """result.all() / result.mappings().all(), with the fetch reported to the slow-query log"""
+    return list(iter_timed(result, mappings))
@@ -0,0 +1,247 @@
+"""Reconciliation report: stock teorico vs conteo, plus server-side rollups.
+
+The admin panel used to total Diferencia/DifCosto/DifPrecio per department,
+provider and model in the browser over the full detail. The rollups are now
+computed here in one pass over the report rows and cached per inventory
+version, so the management screens only download the group totals.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy import text
+from collections import OrderedDict
+from threading import Lock
+from archive import load_archivo, huella_inventario
+from database import run_parallel
+from profiling import iter_timed
+import hashlib
+
+
+# Group-by dimensions exposed by /reporte/resumen (query value -> report column)
+DIMENSIONES = {
+    "departamento": "Departamento",
+    "proveedor": "Proveedor",
+    "modelo": "Modelo",
+    "tipo": "Tipo",
+}
+
+# Additive measures summed per group
+MEDIDAS = ("StockTeorico", "Conteo", "Diferencia", "DifCosto", "DifPrecio")
+# Row counts per group, besides Productos
+CONTADORES = ("Excesos", "Faltas", "Sobrantes")
+
+# Keep rollups for the last few inventories viewed (each holds the full detail for drill-down)
+RESUMEN_CACHE_MAX = 8
+resumen_cache: "OrderedDict[int, dict]" = OrderedDict()
+_resumen_lock = Lock()
+
+
+# Stock vs conteo in one set-based pass: lecturas are pre-aggregated per SKU and
+# FULL OUTER JOINed to the stock, so sobrantes (read but not in stock) come back
+# in the same result. SKUs are trimmed on both sides so int/varchar loads match.
+RECONCILIACION_SQL = text("""
+    WITH st AS (
+        SELECT LTRIM(RTRIM(CAST(SKU AS VARCHAR(50)))) as SKU, ALU, Descripcion,
+            Departamento, Modelo, Proveedor, Temporada, StockTeorico
+        FROM INV_STOCK_TEORICO WHERE IdInventario = :inv
+    ), lec AS (
+        SELECT LTRIM(RTRIM(CAST(SKU AS VARCHAR(50)))) as SKU,
+            MAX(ALU) as ALU, MAX(Descripcion) as Descripcion, SUM(Cantidad) as Conteo
+        FROM INV_LECTURAS WHERE IdInventario = :inv
+        GROUP BY LTRIM(RTRIM(CAST(SKU AS VARCHAR(50))))
+    )
+    SELECT COALESCE(st.SKU, lec.SKU) as SKU,
+        COALESCE(st.ALU, lec.ALU) as ALU,
+        COALESCE(st.Descripcion, lec.Descripcion) as Descripcion,
+        ISNULL(st.Departamento, '') as Departamento,
+        ISNULL(st.Modelo, '') as Modelo,
+        ISNULL(st.Proveedor, '') as Proveedor,
+        ISNULL(st.Temporada, '') as Temporada,
+        ISNULL(st.StockTeorico, 0) as StockTeorico,
+        ISNULL(lec.Conteo, 0) as Conteo,
+        CASE WHEN st.SKU IS NULL THEN 1 ELSE 0 END as Sobrante
+    FROM st
+    FULL OUTER JOIN lec ON lec.SKU = st.SKU
+    ORDER BY CASE WHEN st.SKU IS NULL THEN 1 ELSE 0 END, st.Departamento, st.Modelo
+""")
+
+
+def iter_reconciliacion(db: Session, inv_id: int):
+    """Stream stock vs conteo rows (sobrantes last) straight from the cursor"""
+    result = db.execute(RECONCILIACION_SQL, {"inv": inv_id})
+    for r in iter_timed(result):
+        yield {
+            "SKU": r.SKU or "", "ALU": r.ALU, "Descripcion": r.Descripcion,
+            "Departamento": r.Departamento, "Modelo": r.Modelo,
+            "Proveedor": r.Proveedor, "Temporada": r.Temporada,
+            "StockTeorico": r.StockTeorico, "Conteo": r.Conteo,
+            "Sobrante": bool(r.Sobrante)
+        }
+
+
+def totales_por_dispositivo(db: Session, inv_id: int) -> dict:
+    rows = db.execute(text("""
+        SELECT Dispositivo, SUM(Cantidad) as Total
+        FROM INV_LECTURAS WHERE IdInventario = :inv
+        GROUP BY Dispositivo
+    """), {"inv": inv_id}).mappings().all()
+    return {r["Dispositivo"]: r["Total"] for r in rows}
+
+
+def build_reporte(db: Session, retail_db: Session, inv_id: int) -> list:
+    """Build the per-SKU report rows (stock vs conteo + costs and prices)"""
+    # Archived inventories keep the report materialized at archive time (prices frozen at close)
+    archivo = load_archivo(db, inv_id, "Resumen")
+    if archivo is not None:
+        return archivo["reporte"]
+
+    def load_precios(retail):
+        # Join PRODUCT_STYLE to get Proveedor (Desc2) — same source as Maestra, guaranteed correct.
+        # Departamento is only used for sobrantes, which have no stock row to take it from.
+        rows = iter_timed(retail.execute(text("""
+            SELECT p.SKU,
+                (CASE WHEN p.AvgCost = 0 THEN p.lastcost ELSE p.avgcost END) as Costo,
+                p.RetailPrice as Precio,
+                ISNULL(t.Desc2, '') as Proveedor,
+                ISNULL((SELECT deptname FROM DEPARTMENT WHERE DeptCode=t.DeptCode), '') as Departamento
+            FROM PRODUCT p
+            LEFT JOIN PRODUCT_STYLE t ON p.StyleCode = t.StyleCode
+        """)), mappings=True)
+        # str() on SKU to avoid int/varchar type mismatch in dict lookup
+        return {str(r["SKU"]).strip(): {
+            "costo": float(r["Costo"] or 0),
+            "precio": float(r["Precio"] or 0),
+            "proveedor": str(r["Proveedor"] or ""),
+            "departamento": str(r["Departamento"] or "")
+        } for r in rows}
+
+    # The reconciliation (DBFERRINI) and the price scan (RetailDataSHOE) don't depend
+    # on each other, so they run at the same time on their own connections
+    res = run_parallel({
+        "reconciliacion": (db, lambda s: list(iter_reconciliacion(s, inv_id))),
+        "precios": (retail_db, load_precios),
+    })
+    filas, precios_map = res["reconciliacion"], res["precios"]
+
+    sin_precio = {"costo": 0, "precio": 0, "proveedor": "", "departamento": ""}
+    reporte = []
+    for f in filas:
+        sku = f["SKU"]
+        diff = f["Conteo"] - f["StockTeorico"]
+        p = precios_map.get(sku, sin_precio)
+        # Proveedor from RetailDataSHOE (same source as Maestra); sobrantes also take their department from it
+        departamento = p["departamento"] if f["Sobrante"] else f["Departamento"]
+        proveedor = p["proveedor"]
+        reporte.append({
+            "SKU": sku, "ALU": f["ALU"], "Descripcion": f["Descripcion"],
+            "Departamento": departamento, "Modelo": f["Modelo"],
+            "Proveedor": proveedor,
+            "StockTeorico": f["StockTeorico"], "Conteo": f["Conteo"],
+            "Diferencia": diff, "Costo": p["costo"], "Precio": p["precio"],
+            "DifCosto": round(diff * p["costo"], 2),
+            "DifPrecio": round(diff * p["precio"], 2),
+            "Sobrante": f["Sobrante"]
+        })
+
+    return reporte
+
+
+def get_inventario_version(db: Session, inv_id: int) -> str:
+    """Cheap fingerprint of an inventory's stock and lecturas (changes on any sync/delete)"""
+    return hashlib.md5(repr(huella_inventario(db, inv_id)).encode()).hexdigest()[:12]
+
+
+# Tipo of a report row by Diferencia. Deliberately not "sobrante": in this app a
+# sobrante is a SKU read but absent from the stock teorico (the row's Sobrante flag),
+# which is counted separately; an exceso is any row counted above its stock.
+def _tipo(diferencia) -> str:
+    if diferencia > 0:
+        return "exceso"
+    if diferencia < 0:
+        return "falta"
+    return "cuadrado"
+
+
+def build_resumen(reporte: list) -> tuple:
+    """Totals, every dimension's groups and each group's rows, from a single grouping pass.
+
+    Returns (totales, grupos, filas): grupos[dimension] is sorted biggest DifCosto loss
+    first, filas[dimension][grupo] lists that group's report rows for the drill-down.
+    """
+    # Each row's counters and measures are read once into a tuple (same order as
+    # CONTADORES + MEDIDAS); the groups keep the rows and their tuples side by side
+    # and are summed column-wise at the end
+    filas = {d: {} for d in DIMENSIONES}
+    valores = {d: {} for d in DIMENSIONES}
+    dims = [(col, filas[d], valores[d]) for d, col in DIMENSIONES.items()]
+    todos = []
+    for r in reporte:
+        dif = r["Diferencia"] or 0
+        v = (dif > 0, dif < 0, bool(r.get("Sobrante")), r["StockTeorico"] or 0, r["Conteo"] or 0,
+             dif, r["DifCosto"] or 0, r["DifPrecio"] or 0)
+        todos.append(v)
+        for col, filas_dim, valores_dim in dims:
+            k = _tipo(dif) if col == "Tipo" else str(r[col] or "")
+            grupo = filas_dim.get(k)
+            if grupo is None:
+                filas_dim[k] = [r]
+                valores_dim[k] = [v]
+            else:
+                grupo.append(r)
+                valores_dim[k].append(v)
+
+    grupos = {}
+    for d, valores_dim in valores.items():
+        grupos[d] = sorted((_sumar(vals, Grupo=k) for k, vals in valores_dim.items()),
+                           key=lambda g: g["DifCosto"])
+    return _sumar(todos), grupos, filas
+
+
+def _sumar(valores: list, **extra) -> dict:
+    """Row count plus the column-wise sums of a group's value tuples"""
+    fila = dict(extra)
+    fila["Productos"] = len(valores)
+    sumas = map(sum, zip(*valores)) if valores else [0] * (len(CONTADORES) + len(MEDIDAS))
+    for campo, v in zip(CONTADORES + MEDIDAS, sumas):
+        fila[campo] = round(v, 2) if isinstance(v, float) else v
+    return fila
+
+
+def get_resumen_entry(db: Session, retail_db: Session, inv_id: int) -> dict:
+    """Return the cached rollups for an inventory, rebuilding them if its version changed"""
+    version = get_inventario_version(db, inv_id)
+    with _resumen_lock:
+        entry = resumen_cache.get(inv_id)
+        if entry and entry["version"] == version:
+            resumen_cache.move_to_end(inv_id)
+            return entry
+
+    totales, grupos, filas = build_resumen(build_reporte(db, retail_db, inv_id))
+    entry = {
+        "version": version,
+        "filas": filas,
+        "resumen": {
+            "version": version,
+            "totales": totales,
+            "grupos": grupos,
+        },
+    }
+    with _resumen_lock:
+        resumen_cache[inv_id] = entry
+        resumen_cache.move_to_end(inv_id)
+        while len(resumen_cache) > RESUMEN_CACHE_MAX:
+            resumen_cache.popitem(last=False)
+    return entry
+
+
+def drill_down(entry: dict, dimension: str, grupo: str, page: int, page_size: int) -> dict:
+    """Detail rows of one group, paginated"""
+    rows = entry["filas"][dimension].get(grupo, [])
+    start = (page - 1) * page_size
+    return {
+        "version": entry["version"],
+        "dimension": dimension,
+        "grupo": grupo,
+        "page": page,
+        "pageSize": page_size,
+        "total": len(rows),
+        "productos": rows[start:start + page_size],
+    }
@@ -3,7 +3,7 @@
  * Material Design 3 + Optimized for Honeywell PDAs
  *
  * Features:
- * - Offline-first with localStorage caching
+ * - Offline-first with localStorage caching (lecturas in an IndexedDB journal)
  * - Auto-sync every 30 seconds
  * - Honeywell hardware scanner integration
  * - Real-time product lookup
@@ -53,8 +53,119 @@ const Icons = {
     trash: `<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><path d="M3 6h18"/><path d="M19 6v14c0 1-1 2-2 2H7c-1 0-2-1-2-2V6"/><path d="M8 6V4c0-1 1-2 2-2h4c1 0 2 1 2 2v2"/><line x1="10" x2="10" y1="11" y2="17"/><line x1="14" x2="14" y1="11" y2="17"/></svg>`
 };
 
+// --- Lecturas persistence (IndexedDB journal) ---
+// saveLecturas() used to JSON.stringify the whole State.lecturas into localStorage on
+// every scan, which got slower with every line a handset held. Each change is now one
+// small append to a journal of the array mutations (O(1) per scan). The full list is
+// only written as a snapshot after a successful sync, or when the journal grows past
+// COMPACT_EVERY entries; loading replays snapshot + journal. If IndexedDB is not
+// available the app falls back to the old full localStorage write.
+const LecturasStore = {
+    DB_NAME: 'inv_lecturas',
+    DB_VERSION: 1,
+    COMPACT_EVERY: 500,
+    db: null,
+    ready: null,    // promise of db (null when IndexedDB is unavailable)
+    seq: 0,         // last journal seq of the loaded inventory (assigned here, not by IndexedDB)
+    count: 0,       // journal entries since the last snapshot
+
+    open() {
+        this.ready = new Promise(resolve => {
+            if (!window.indexedDB) return resolve(null);
+            const req = indexedDB.open(this.DB_NAME, this.DB_VERSION);
+            req.onupgradeneeded = () => {
+                const db = req.result;
+                db.createObjectStore('journal', { keyPath: ['inv', 'seq'] });
+                db.createObjectStore('snapshot', { keyPath: 'inv' });
+            };
+            req.onsuccess = () => { this.db = req.result; resolve(this.db); };
+            req.onerror = () => { console.warn('IndexedDB unavailable, using localStorage:', req.error); resolve(null); };
+        });
+        return this.ready;
+    },
+
+    // Run fn(...stores) in one transaction; resolves with its result once committed
+    tx(names, mode, fn) {
+        return new Promise((resolve, reject) => {
+            const t = this.db.transaction(names, mode);
+            let result;
+            t.oncomplete = () => resolve(result);
+            t.onerror = () => reject(t.error);
+            t.onabort = () => reject(t.error);
+            result = fn(...names.map(n => t.objectStore(n)));
+        });
+    },
+
+    request(req) {
+        return new Promise((resolve, reject) => {
+            req.onsuccess = () => resolve(req.result);
+            req.onerror = () => reject(req.error);
+        });
+    },
+
+    range(inv, hasta = Infinity) {
+        return IDBKeyRange.bound([Number(inv), 0], [Number(inv), hasta]);
+    },
+
+    // Same mutations the app makes on State.lecturas, replayed in order
+    apply(lecturas, op) {
+        if (op.op === 'unshift') lecturas.unshift({ ...op.item });
+        else if (op.op === 'push') lecturas.push({ ...op.item });
+        else if (op.op === 'cantidad') lecturas[op.i].cantidad = op.cantidad;
+        else if (op.op === 'remove') lecturas.splice(op.i, 1);
+    },
+
+    // Lecturas of an inventory, or null if nothing was ever stored for it
+    async load(inv) {
+        const [snap, ops] = await this.tx(['snapshot', 'journal'], 'readonly', (snapshot, journal) =>
+            Promise.all([this.request(snapshot.get(Number(inv))), this.request(journal.getAll(this.range(inv)))]));
+        if (!snap && !ops.length) {
+            this.seq = 0;
+            this.count = 0;
+            return null;
+        }
+        const lecturas = snap ? snap.lecturas : [];
+        const desde = snap ? snap.seq : 0;
+        for (const op of ops) {
+            if (op.seq > desde) this.apply(lecturas, op);
+        }
+        this.seq = ops.length ? Math.max(desde, ops[ops.length - 1].seq) : desde;
+        this.count = ops.length;
+        return lecturas;
+    },
+
+    // Record one mutation already applied to `lecturas` (the live State.lecturas)
+    append(inv, op, lecturas) {
+        const seq = ++this.seq;
+        // Transactions on the journal run in creation order, so seq order == call order
+        const write = this.tx(['journal'], 'readwrite', journal => { journal.add({ ...op, inv: Number(inv), seq }); });
+        if (++this.count >= this.COMPACT_EVERY) this.compact(inv, lecturas.map(l => ({ ...l })), seq);
+        return write;
+    },
+
+    // Snapshot `lecturas` as the state at `hasta` and drop the journal entries it covers
+    compact(inv, lecturas, hasta) {
+        this.count = Math.max(0, this.seq - hasta);
+        return this.tx(['snapshot', 'journal'], 'readwrite', (snapshot, journal) => {
+            snapshot.get(Number(inv)).onsuccess = e => {
+                // A later snapshot (periodic compaction during a slow sync) already covers this one
+                if (e.target.result && e.target.result.seq > hasta) return;
+                snapshot.put({ inv: Number(inv), seq: hasta, lecturas });
+                journal.delete(this.range(inv, hasta));
+            };
+        });
+    },
+
+    // Replace everything stored for the inventory (server restore, localStorage import)
+    replace(inv, lecturas) {
+        return this.compact(inv, lecturas.map(l => ({ ...l })), this.seq);
+    }
+};
+
 const app = {
     init() {
+        LecturasStore.open();
+
         // Restore saved values
         $('inputServer').value = localStorage.getItem(CONFIG.SERVER_KEY) || CONFIG.DEFAULT_SERVER;
         $('inputDevice').value = localStorage.getItem(CONFIG.DEVICE_KEY) || 'Lectora 1';
@@ -187,7 +298,7 @@ const app = {
         } catch { return false; }
     },
 
-    tryOfflineMode() {
+    async tryOfflineMode() {
         // Ensure State has device name (in case called directly from button)
         if (!State.deviceName) {
             State.deviceName = $('inputDevice').value.trim() || localStorage.getItem(CONFIG.DEVICE_KEY) || 'PDA';
@@ -205,7 +316,7 @@ const app = {
             const inv = JSON.parse(saved);
             State.inventarioId = inv.id;
             State.inventarioNombre = inv.nombre;
-            this.restoreLecturas();
+            await this.restoreLecturas();
             this.enterScanView();
             this.toast('Modo OFFLINE — datos en cache', 'warning');
             this.addLog('info', 'Iniciado en modo offline (sin conexion al servidor)');
@@ -241,7 +352,7 @@ const app = {
                     // No changes, use cache
                     $('downloadMsg').textContent = `Maestra actualizada: ${State.maestraBySKU.size.toLocaleString()} productos`;
                     this.updateProgress(100);
-                    this.restoreLecturas();
+                    await this.restoreLecturas();
                     setTimeout(() => this.enterScanView(), 500);
                     return;
                 } else {
@@ -254,7 +365,7 @@ const app = {
                 // Can't check version, use cache anyway
                 $('downloadMsg').textContent = `Usando cache: ${State.maestraBySKU.size.toLocaleString()} productos`;
                 this.updateProgress(100);
-                this.restoreLecturas();
+                await this.restoreLecturas();
                 setTimeout(() => this.enterScanView(), 500);
                 return;
             }
@@ -265,7 +376,7 @@ const app = {
             await this.downloadMaestra();
         }
 
-        this.restoreLecturas();
+        await this.restoreLecturas();
         setTimeout(() => this.enterScanView(), 500);
     },
 
@@ -365,20 +476,33 @@ const app = {
     },
 
     
-    restoreLecturas() {
+    async restoreLecturas() {
         const key = CONFIG.LECTURAS_KEY + '_' + State.inventarioId;
         const saved = localStorage.getItem(key);
+        let lecturas = null;
 
+        if (await LecturasStore.ready) {
+            try {
+                lecturas = await LecturasStore.load(State.inventarioId);
+            } catch (e) {
+                console.error('Error reading lecturas journal:', e);
+            }
+        }
         if (saved) {
+            // Full list written by the localStorage fallback or an older app version: newest copy
             try {
-                State.lecturas = JSON.parse(saved);
-            } catch {
-                State.lecturas = [];
+                lecturas = JSON.parse(saved);
+                if (LecturasStore.db) {
+                    await LecturasStore.replace(State.inventarioId, lecturas);
+                    localStorage.removeItem(key);
+                }
+            } catch (e) {
+                console.error('Error importing saved lecturas:', e);
             }
-        } else {
-            State.lecturas = [];
-            this.restoreFromServer();
         }
+
+        State.lecturas = lecturas || [];
+        if (!lecturas) this.restoreFromServer();
     },
 
     async restoreFromServer() {
@@ -397,7 +521,7 @@ const app = {
                     origen: r.Origen || 'scanner'
                 }));
                 State.pendingSync = false;
-                this.saveLecturas();
+                this.saveLecturas(true);
                 this.renderLecturas();
                 this.updateSyncStatus();
                 this.toast('Lecturas restauradas del servidor');
@@ -593,18 +717,20 @@ const app = {
 
         if (existing) {
             existing.cantidad += cantidad;
+            this.saveLecturas({ op: 'cantidad', i: State.lecturas.indexOf(existing), cantidad: existing.cantidad });
         } else {
-            State.lecturas.unshift({
+            const item = {
                 sku: p.sku,
                 alu: p.alu,
                 descripcion: p.descripcion,
                 cantidad: cantidad,
                 ubicacion: ubicacion,
                 origen: p.origen || 'scanner'
-            });
+            };
+            State.lecturas.unshift(item);
+            this.saveLecturas({ op: 'unshift', item });
         }
 
-        this.saveLecturas();
         this.renderLecturas();
         this.toast(`+${cantidad} ${p.descripcion}`);
         State.pendingSync = true;
@@ -620,9 +746,22 @@ const app = {
     },
 
     // --- Lecturas Management ---
-    saveLecturas() {
-        const key = CONFIG.LECTURAS_KEY + '_' + State.inventarioId;
-        localStorage.setItem(key, JSON.stringify(State.lecturas));
+    // Persist a change already made to State.lecturas: `op` is the mutation to journal,
+    // `true` replaces the whole stored list
+    saveLecturas(op) {
+        const inv = State.inventarioId;
+        const fullWrite = () => localStorage.setItem(CONFIG.LECTURAS_KEY + '_' + inv, JSON.stringify(State.lecturas));
+        if (!LecturasStore.db) return fullWrite();
+        const write = op === true
+            ? LecturasStore.replace(inv, State.lecturas)
+            : LecturasStore.append(inv, op, State.lecturas);
+        // On failure stay on localStorage for the session: restoreLecturas() treats that copy
+        // as the newest one and imports it back into IndexedDB on the next start
+        write.catch(e => {
+            console.error('Error saving lecturas journal, falling back to localStorage:', e);
+            LecturasStore.db = null;
+            fullWrite();
+        });
     },
 
     renderLecturas() {
@@ -676,15 +815,17 @@ const app = {
             if (isNaN(n) || n <= 0) return;
             if (n >= l.cantidad) {
                 State.lecturas.splice(index, 1); // delete all
+                this.saveLecturas({ op: 'remove', i: index });
             } else {
                 l.cantidad -= n; // reduce quantity
+                this.saveLecturas({ op: 'cantidad', i: index, cantidad: l.cantidad });
             }
         } else {
             if (!confirm(`Eliminar "${l.descripcion}"?`)) return;
             State.lecturas.splice(index, 1);
+            this.saveLecturas({ op: 'remove', i: index });
         }
 
-        this.saveLecturas();
         this.renderLecturas();
         this.toast('Lectura actualizada', 'warning');
         State.pendingSync = true;
@@ -1006,18 +1147,20 @@ const app = {
         );
         if (existing) {
             existing.cantidad += cantidad;
+            this.saveLecturas({ op: 'cantidad', i: State.lecturas.indexOf(existing), cantidad: existing.cantidad });
         } else {
-            State.lecturas.push({
+            const item = {
                 sku: prod.sku,
                 alu: prod.alu,
                 descripcion: prod.descripcion,
                 cantidad,
                 ubicacion,
                 origen: 'manual'
-            });
+            };
+            State.lecturas.push(item);
+            this.saveLecturas({ op: 'push', item });
         }
 
-        this.saveLecturas();
         State.pendingSync = true;
         this.updateSyncStatus();
         this.addLog('info', `Manual: ${prod.descripcion} x${cantidad} - ${State.deviceName}`);
@@ -1065,15 +1208,21 @@ const app = {
         const totalLecturas = State.lecturas.reduce((s, l) => s + l.cantidad, 0);
         const totalItems = State.lecturas.length;
 
+        // What is being sent, and the journal position it corresponds to (scans made while
+        // the request is in flight stay in the journal)
+        const inv = State.inventarioId;
+        const enviadas = State.lecturas.map(l => ({ ...l }));
+        const hasta = LecturasStore.seq;
+
         try {
             this.updateDot('syncing');
 
-            const r = await fetch(`${State.apiUrl}/api/inventario/${State.inventarioId}/sync`, {
+            const r = await fetch(`${State.apiUrl}/api/inventario/${inv}/sync`, {
                 method: 'POST',
                 headers: {'Content-Type': 'application/json'},
                 body: JSON.stringify({
                     dispositivo: State.deviceName,
-                    lecturas: State.lecturas.map(l => ({
+                    lecturas: enviadas.map(l => ({
                         sku: String(l.sku || ''),
                         alu: String(l.alu || ''),
                         descripcion: String(l.descripcion || ''),
@@ -1086,6 +1235,11 @@ const app = {
             });
 
             if (r.ok) {
+                // The server now holds this list: fold the journal into a snapshot
+                if (LecturasStore.db && inv === State.inventarioId) {
+                    LecturasStore.compact(inv, enviadas, hasta)
+                        .catch(e => console.error('Error compacting lecturas journal:', e));
+                }
                 State.lastSync = new Date();
                 State.isOnline = true;
                 State.pendingSync = false;